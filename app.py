@@ -1,14 +1,33 @@
+import json
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, abort, Response
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Reaction, Thread, DM
+from instrumentation import Instrumentation
+import metrics
+from models import (db, connect_db, User, Message, Reaction,
+                    MessageReactionCount, Thread, DM,
+                    FollowersFollowee, Timeline, TimelineEntry, KeysetPaged,
+                    UserCard, MessageRow, TIMELINE_SLACK)
+from passwords import HashingPoolFull
+from pubsub import LocalPubSub, PostgresPubSub
+import query_plans
 
 CURR_USER_KEY = "curr_user"
 
+# icon class shown in templates -> reaction_type stored in the DB
+REACTION_CLASSES = {"fa-smile": "smile",
+                    "fa-sad-cry": "sad",
+                    "fa-laugh-squint": "laugh",
+                    "fa-angry": "angry"}
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -20,24 +39,125 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 48
+app.config['SEARCH_RESULTS_LIMIT'] = 48
+app.config['DMS_PER_FETCH'] = 100
+app.config['DMS_PER_PAGE'] = 50
+app.config['REACTIONS_PER_BATCH'] = 100
+# 'local' (one process) or 'postgres' (LISTEN/NOTIFY, for several workers).
+# Postgres whenever the database is, since the Procfile's web and stream
+# processes have to reach each other's streams; set 'local' for a single
+# `flask run` process.
+app.config['PUBSUB_BACKEND'] = os.environ.get(
+    'PUBSUB_BACKEND',
+    'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres')
+    else 'local')
+# seconds between keepalive comments on idle DM streams
+app.config['STREAM_KEEPALIVE'] = 15
+# seconds a logged-in user's row is reused across requests (0 turns it off)
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 5))
+app.config['USER_CACHE_SIZE'] = 10000
+# bcrypt work factor; existing hashes are upgraded to it on login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# bcrypt threads per process, and how many requests may wait on them.
+# Keep the second under the Procfile's --threads 4, so a burst of logins
+# always leaves request threads free for everything else.
+app.config['BCRYPT_MAX_WORKERS'] = int(os.environ.get('BCRYPT_MAX_WORKERS', 2))
+app.config['BCRYPT_MAX_PENDING'] = int(os.environ.get('BCRYPT_MAX_PENDING', 2))
+# requests slower than this, or running more queries, are logged with
+# their queries
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_REQUEST_QUERIES'] = int(
+    os.environ.get('SLOW_REQUEST_QUERIES', 50))
+app.config['SERVER_TIMING'] = True
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+migrate = Migrate(app, db)
+
+# first, so the queries of every other before_request function count
+instrumentation = Instrumentation()
+instrumentation.init_app(app, db.engine)
+metrics.init_app(app, db.engine)
+
+if app.config['PUBSUB_BACKEND'] == 'postgres':
+    pubsub = PostgresPubSub(db.engine)
+else:
+    pubsub = LocalPubSub()
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+# user id -> (expiry time, column values) for recently loaded users.
+# Per process, so another gunicorn worker may serve a row up to
+# USER_CACHE_TTL seconds old; the routes that change the current user
+# call forget_cached_user() so at least that worker is never stale.
+user_cache = {}
+
+# the hash has no business sitting in memory; it's loaded on access
+USER_CACHE_COLUMNS = [c.key for c in User.__table__.columns
+                      if c.key != 'password']
+
+
+def load_user(user_id):
+    """Get the user for `user_id`, from user_cache if it's fresh enough."""
+
+    cached = user_cache.get(user_id)
+
+    if cached and cached[0] > time.monotonic():
+        metrics.USER_CACHE.labels('hit').inc()
+        # rebuild a persistent instance without a SELECT
+        user = User(**cached[1])
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    metrics.USER_CACHE.labels('miss').inc()
+    user = User.query.get(user_id)
+    ttl = app.config['USER_CACHE_TTL']
+
+    if user and ttl:
+        if len(user_cache) >= app.config['USER_CACHE_SIZE']:
+            user_cache.clear()
+        user_cache[user_id] = (
+            time.monotonic() + ttl,
+            {key: getattr(user, key) for key in USER_CACHE_COLUMNS})
+
+    return user
+
+
+def forget_cached_user(user_id):
+    """Drop `user_id` from user_cache after changing their row."""
+
+    user_cache.pop(user_id, None)
+
+
+def user_id_only(view):
+    """Mark a view as only needing g.user_id, so we don't load g.user."""
+
+    view.user_id_only = True
+    return view
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user (and their id) to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Static files and views marked @user_id_only just get the id from the
+    session, without touching the DB.
+    """
 
-    else:
-        g.user = None
+    g.user_id = session.get(CURR_USER_KEY)
+    g.user = None
+
+    view = app.view_functions.get(request.endpoint)
+
+    if (g.user_id and request.endpoint != 'static'
+            and not getattr(view, 'user_id_only', False)):
+        g.user = load_user(g.user_id)
 
 
 def do_login(user):
@@ -98,6 +218,8 @@ def login():
                                  form.data['password'])
 
         if user:
+            # saves the password hash if authenticate() upgraded its cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -115,6 +237,33 @@ def logout():
     return redirect("/login")
 
 
+def get_page(fetch, per_page):
+    """Fetch one page of messages (or dms) using the `before` cursor in the
+    query string.
+
+    `fetch(before, limit)` returns newest-first rows. We ask it for one
+    extra row so we know whether there's an older page.
+
+    Returns (rows, cursor for the next page or None).
+    """
+
+    before = request.args.get('before')
+
+    if before:
+        try:
+            before = KeysetPaged.parse_cursor(before)
+        except ValueError:
+            abort(400)
+
+    rows = fetch(before, per_page + 1)
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return rows, rows[-1].cursor
+
+    return rows, None
+
+
 ##############################################################################
 # General user routes:
 
@@ -128,17 +277,35 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username (best
+    matches first), or an 'after' param (a user id) to get the next page.
     """
 
     search = request.args.get('q')
+    after = request.args.get('after', type=int)
+    per_page = app.config['USERS_PER_PAGE']
+    next_after = None
+
+    if search:
+        # ranked, so no paging: just the best matches
+        users = User.search(search, app.config['SEARCH_RESULTS_LIMIT'])
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        query = User.query
+
+        if after:
+            query = query.filter(User.id > after)
+
+        users = query.order_by(User.id).limit(per_page + 1).all()
+
+        if len(users) > per_page:
+            users = users[:per_page]
+            next_after = users[-1].id
 
-    return render_template('users/index.html', users=users)
+    following_ids = g.user.get_following_ids([u.id for u in users]) if g.user else set()
+
+    return render_template('users/index.html', users=users, following_ids=following_ids,
+                           next_after=next_after)
 
 
 @app.route('/users/<int:user_id>')
@@ -146,8 +313,12 @@ def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
-    reactions_number = len(user.reacted_messages)
-    return render_template('users/show.html', user=user, reactions_number=reactions_number)
+
+    messages, next_cursor = get_page(
+        lambda before, limit: Message.page(user.messages, before, limit),
+        app.config['MESSAGES_PER_PAGE'])
+
+    return render_template('users/show.html', user=user, messages=messages, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -159,9 +330,11 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    reactions_number = len(user.reacted_messages)
+    people = UserCard.load(user.following.order_by(User.id))
+    following_ids = g.user.get_following_ids([p.id for p in people])
 
-    return render_template('users/following.html', user=user, reactions_number=reactions_number)
+    return render_template('users/following.html', user=user, people=people,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -173,9 +346,11 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    reactions_number = len(user.reacted_messages)
+    people = UserCard.load(user.followers.order_by(User.id))
+    following_ids = g.user.get_following_ids([p.id for p in people])
 
-    return render_template('users/followers.html', user=user, reactions_number=reactions_number)
+    return render_template('users/followers.html', user=user, people=people,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/reactions')
@@ -187,19 +362,13 @@ def users_reactions(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    messages = user.reacted_messages
+    messages = MessageRow.load(Message.reacted_to_by(user_id))
 
-    sad = g.user.get_reactions("sad")
-    smile = g.user.get_reactions("smile")
-    laugh = g.user.get_reactions("laugh")
-    angry = g.user.get_reactions("angry")
+    reaction_types, my_msgs = get_reaction_types(messages)
+    reaction_counts = get_reaction_counts(messages)
 
-    reaction_types = {"fa-smile": smile,
-                      "fa-sad-cry": sad,
-                      "fa-laugh-squint": laugh,
-                      "fa-angry": angry}
-
-    return render_template('users/reactions.html', user=user, messages=messages, reaction_types=reaction_types, reactions_number=len(messages))
+    return render_template('users/reactions.html', user=user, messages=messages, reaction_types=reaction_types,
+                           my_msgs=my_msgs, reaction_counts=reaction_counts)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -211,8 +380,15 @@ def add_follow(follow_id):
         return redirect("/")
 
     followee = User.query.get_or_404(follow_id)
-    g.user.following.append(followee)
-    db.session.commit()
+
+    if not g.user.is_following(followee):
+        g.user.following.append(followee)
+        db.session.flush()
+        Timeline.add_author(g.user.id, followee.id)
+        User.adjust_counters(g.user.id, following_count=1)
+        User.adjust_counters(followee.id, followers_count=1)
+        db.session.commit()
+        forget_cached_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -226,8 +402,14 @@ def stop_following(follow_id):
         return redirect("/")
 
     followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
-    db.session.commit()
+
+    if followee and g.user.is_following(followee):
+        g.user.following.remove(followee)
+        Timeline.remove_author(g.user.id, followee.id)
+        User.adjust_counters(g.user.id, following_count=-1)
+        User.adjust_counters(followee.id, followers_count=-1)
+        db.session.commit()
+        forget_cached_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -250,6 +432,7 @@ def profile():
                 g.user.header_image_url = request.form["header_image_url"] or None
                 g.user.bio = request.form["bio"] or None
                 db.session.commit()
+                forget_cached_user(g.user.id)
                 flash("Sucessfully updated", "success")
                 return redirect(f"users/{g.user.id}")
             else:
@@ -272,8 +455,45 @@ def delete_user():
 
     do_logout()
 
+    # the follows rows go with the user; take them off the other side's
+    # counters first
+    (User
+     .query
+     .filter(User.id.in_(db.session
+                         .query(FollowersFollowee.follower_id)
+                         .filter(FollowersFollowee.followee_id == g.user.id)))
+     .update({User.followers_count: User.followers_count - 1},
+             synchronize_session=False))
+    (User
+     .query
+     .filter(User.id.in_(db.session
+                         .query(FollowersFollowee.followee_id)
+                         .filter(FollowersFollowee.follower_id == g.user.id)))
+     .update({User.following_count: User.following_count - 1},
+             synchronize_session=False))
+    MessageReactionCount.remove_user(g.user.id)
+
+    # so do their messages, and other users' reactions to them
+    reactions = (Reaction
+                 .query
+                 .join(Message, Message.id == Reaction.message_id)
+                 .filter(Message.user_id == g.user.id,
+                         Reaction.user_id != g.user.id))
+    (User
+     .query
+     .filter(User.id.in_(reactions.with_entities(Reaction.user_id)))
+     .update({User.reactions_count:
+              User.reactions_count -
+              (reactions
+               .with_entities(db.func.count())
+               .filter(Reaction.user_id == User.id)
+               .correlate(User)
+               .as_scalar())},
+             synchronize_session=False))
+
     db.session.delete(g.user)
     db.session.commit()
+    forget_cached_user(g.user_id)
 
     return redirect("/signup")
 
@@ -297,7 +517,11 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.data['text'])
         g.user.messages.append(msg)
+        db.session.flush()
+        Timeline.fan_out(msg)
+        User.adjust_counters(g.user.id, messages_count=1)
         db.session.commit()
+        forget_cached_user(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -321,8 +545,27 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    Timeline.remove_message(msg.id)
+    User.adjust_counters(msg.user_id, messages_count=-1)
+
+    # the reactions go with the message; take them off their users'
+    # counters first (a user may have more than one type on it)
+    reactions = Reaction.query.filter(Reaction.message_id == msg.id)
+    (User
+     .query
+     .filter(User.id.in_(reactions.with_entities(Reaction.user_id)))
+     .update({User.reactions_count:
+              User.reactions_count -
+              (reactions
+               .with_entities(db.func.count())
+               .filter(Reaction.user_id == User.id)
+               .correlate(User)
+               .as_scalar())},
+             synchronize_session=False))
+
     db.session.delete(msg)
     db.session.commit()
+    forget_cached_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -331,34 +574,120 @@ def messages_destroy(message_id):
 
 
 @app.route('/addreaction', methods=["POST"])
+@user_id_only
 def add_reaction():
     """Add reaction to DB"""
-    if not g.user:
+    if not g.user_id:
         flash("Unauthorized to complete action", "danger")
         return redirect("/")
 
     reaction_type = request.json["type"]
     msg_id = request.json["msgId"]
-    reaction = Reaction(user_id=g.user.id, message_id=msg_id,
-                        reaction_type=reaction_type)
-    db.session.add(reaction)
+    Reaction.add(g.user_id, msg_id, reaction_type)
     db.session.commit()
+    forget_cached_user(g.user_id)
     return jsonify({'msg': 'Added Reaction!'})
 
 
 @app.route('/deletereaction', methods=["DELETE"])
+@user_id_only
 def delete_reaction():
     """Delete reaction to DB"""
-    if not g.user:
+    if not g.user_id:
         flash("Unauthorized to complete action", "danger")
         return redirect("/")
     reaction_type = request.json["type"]
     msg_id = request.json["msgId"]
-    reaction = Reaction.query.get((g.user.id, msg_id, reaction_type))
-    db.session.delete(reaction)
+    Reaction.remove(g.user_id, msg_id, reaction_type)
     db.session.commit()
+    forget_cached_user(g.user_id)
     return jsonify({'msg': 'Deleted Reaction!'})
 
+
+@app.route('/reactions/batch', methods=["POST"])
+@user_id_only
+def batch_reactions():
+    """Apply a batch of reaction changes in one transaction.
+
+    Takes {"ops": [{"msgId": 1, "type": "smile", "on": true}, ...]}. Each
+    op says whether the user should have that reaction (the last op for a
+    reaction wins), so sending a batch twice is harmless. Responds with
+    the resulting state and total of every reaction in the batch:
+
+    {"reactions": [{"msgId": 1, "type": "smile", "on": true, "count": 3}]}
+
+    Ops on messages that don't exist are left out.
+    """
+    if not g.user_id:
+        return jsonify({'msg': 'Unauthorized'}), 403
+
+    ops = (request.get_json(silent=True) or {}).get('ops')
+    if (not isinstance(ops, list) or
+            len(ops) > app.config['REACTIONS_PER_BATCH']):
+        abort(400)
+
+    wanted = {}
+    try:
+        for op in ops:
+            if op['type'] not in REACTION_CLASSES.values():
+                abort(400)
+            wanted[(int(op['msgId']), op['type'])] = bool(op['on'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    message_ids = {message_id for message_id, in db.session
+                   .query(Message.id)
+                   .filter(Message.id.in_({m for m, _ in wanted}))}
+
+    # sorted, so concurrent batches take row locks in the same order
+    changes = sorted((key, on) for key, on in wanted.items()
+                     if key[0] in message_ids)
+
+    for (message_id, reaction_type), on in changes:
+        if on:
+            Reaction.add(g.user_id, message_id, reaction_type)
+        else:
+            Reaction.remove(g.user_id, message_id, reaction_type)
+
+    db.session.commit()
+    forget_cached_user(g.user_id)
+
+    totals = MessageReactionCount.totals_for(list(message_ids))
+
+    return jsonify({'reactions': [
+        {'msgId': message_id,
+         'type': reaction_type,
+         'on': on,
+         'count': totals.get(reaction_type, {}).get(message_id, 0)}
+        for (message_id, reaction_type), on in changes]})
+
+
+def get_reaction_types(messages):
+    """Current user's reaction state for the messages being rendered.
+
+    Returns ({icon class: {message_id, ...}}, {my message_id, ...}).
+    """
+
+    reactions, my_msgs = g.user.get_reaction_state([m.id for m in messages])
+
+    reaction_types = {icon: reactions.get(reaction_type, set())
+                      for icon, reaction_type in REACTION_CLASSES.items()}
+
+    return reaction_types, my_msgs
+
+
+def get_reaction_counts(messages):
+    """Reaction totals for the messages being rendered.
+
+    Returns {icon class: {message_id: count, ...}}.
+    """
+
+    totals = MessageReactionCount.totals_for([m.id for m in messages])
+
+    return {icon: totals.get(reaction_type, {})
+            for icon, reaction_type in REACTION_CLASSES.items()}
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -368,32 +697,33 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees, a page at a time
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        def fetch(before, limit):
+            messages = Timeline.messages_for(g.user.id, limit, before)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+            if messages is None:
+                # the timeline can't serve this page: use the slow query,
+                # and build the timeline if that's why, so the next visit
+                # is a cheap lookup
+                if not Timeline.query.get(g.user.id):
+                    Timeline.rebuild(g.user.id)
+                    db.session.commit()
 
-        sad = g.user.get_reactions("sad")
-        smile = g.user.get_reactions("smile")
-        laugh = g.user.get_reactions("laugh")
-        angry = g.user.get_reactions("angry")
+                messages = MessageRow.page(Message.feed(g.user.id),
+                                           before, limit)
 
-        my_msgs = g.user.get_my_messages()
+            return messages
 
-        reaction_types = {"fa-smile": smile,
-                          "fa-sad-cry": sad,
-                          "fa-laugh-squint": laugh,
-                          "fa-angry": angry}
+        messages, next_cursor = get_page(fetch, app.config['MESSAGES_PER_PAGE'])
 
-        return render_template('home.html', messages=messages, reaction_types=reaction_types, my_msgs=my_msgs)
+        reaction_types, my_msgs = get_reaction_types(messages)
+        reaction_counts = get_reaction_counts(messages)
+
+        return render_template('home.html', messages=messages, reaction_types=reaction_types, my_msgs=my_msgs,
+                               reaction_counts=reaction_counts, next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
@@ -406,58 +736,47 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(HashingPoolFull)
+def hashing_pool_full(e):
+    """Too many logins/signups in flight: ask the client to come back."""
+
+    return render_template('busy.html'), 503, {'Retry-After': '1'}
+
+
 ##############################################################################
 # Thread and DM pages
 
 
 @app.route('/threads')
 def list_threads():
-    """Page with listing of threads.
+    """Page with listing of threads, most recently active first.
     """
-    # query the threads where I'm user 1
-    my_user1_threads = Thread.query.filter(Thread.user1_id == g.user.id).all()
-    # query the threads where I'm user 2
-    my_user2_threads = Thread.query.filter(Thread.user2_id == g.user.id).all()
-    return render_template('threads.html', my_user1_threads=my_user1_threads, my_user2_threads=my_user2_threads)
-
-    # get all the users talk to me
-    # get all the users i'm talking to
 
-    # for in the combined list
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    # look up their thread
-    # put it in [[user, thread], [user, thread]]
+    threads = Thread.inbox(g.user.id)
+    return render_template('threads.html', threads=threads)
 
 
 @app.route('/threads/add/<int:user_id>', methods=['POST'])
+@user_id_only
 def add_thread(user_id):
-    """Page to add a thread. """
-    # if this user id combo exists
-    thread = Thread.query.filter(
-        Thread.user1_id == user_id, Thread.user2_id == g.user.id).all()
-
-    thread2 = Thread.query.filter(
-        Thread.user2_id == user_id, Thread.user1_id == g.user.id).all()
-
-    if thread:
-        return redirect(f'threads/{thread[0].id}')
-
-    if thread2:
-        return redirect(f'threads/{thread2[0].id}')
+    """Go to the thread with this user, starting it if there isn't one. """
+    if not g.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    # else:
-    if (user_id < g.user.id):
-        new_thread = Thread(user1_id=user_id, user2_id=g.user.id)
-    else:
-        new_thread = Thread(user1_id=g.user.id, user2_id=user_id)
-    db.session.add(new_thread)
+    thread_id = Thread.get_or_create_id(g.user_id, user_id)
     db.session.commit()
-    return redirect(f'threads/{new_thread.id}')
+    return redirect(f'/threads/{thread_id}')
 
 
 @app.route('/threads/<int:thread_id>')
 def show_thread(thread_id):
-    """Page to see a thread. """
+    """Page to see a thread: its latest DMS_PER_PAGE dms; older ones are
+    fetched from /threads/<id>/history."""
     thread = Thread.query.get(thread_id)
     if g.user.id == thread.user1_id or g.user.id == thread.user2_id:
         if (g.user.id == thread.user1_id):
@@ -465,22 +784,230 @@ def show_thread(thread_id):
         else:
             other_username = thread.user1.username
 
-        return render_template("show-thread.html", thread=thread, other_username=other_username)
+        dms, before = get_page_of_dms(thread)
+        return render_template("show-thread.html", thread=thread, other_username=other_username,
+                               dms=dms, before=before)
     else:
         flash('Unauthorized', 'danger')
         return redirect('/')
 
 
 @app.route('/threads/<int:thread_id>/dm/add', methods=["POST"])
+@user_id_only
 def add_dm(thread_id):
-    """adds a dm"""
-    thread = Thread.query.get(thread_id)
+    """Adds a dm; responds with just the new dm."""
+    thread = Thread.query.get_or_404(thread_id)
+    if not thread.has_member(g.user_id):
+        return jsonify({'msg': 'Unauthorized'}), 403
+
     text = request.json["text"]
-    dm = DM(text=text, thread_id=thread_id, author=g.user.id)
+    dm = DM(text=text, thread_id=thread_id, author=g.user_id)
     db.session.add(dm)
+    db.session.flush()
+    Thread.record_dm(dm)
+    db.session.commit()
+
+    event = dm.serialize()
+    if pubsub.max_payload and len(json.dumps(event)) > pubsub.max_payload:
+        # too big to push: streams get the id and fetch the rest
+        event = {'id': dm.id, 'author': dm.author}
+    pubsub.publish(f"thread:{thread_id}", event)
+
+    return jsonify(dm.serialize()), 201
+
+
+@app.route('/threads/<int:thread_id>/dms')
+@user_id_only
+def list_dms(thread_id):
+    """DMs in a thread newer than the 'after' dm id, oldest first.
+
+    Returns at most DMS_PER_FETCH; clients keep asking with the last id
+    they got until they get an empty list.
+    """
+    thread = Thread.query.get_or_404(thread_id)
+    if not thread.has_member(g.user_id):
+        return jsonify({'msg': 'Unauthorized'}), 403
+
+    after = request.args.get('after', 0, type=int)
+    dms = (DM
+           .query
+           .filter(DM.thread_id == thread_id, DM.id > after)
+           .order_by(DM.id)
+           .limit(app.config['DMS_PER_FETCH'])
+           .all())
+    return jsonify([dm.serialize() for dm in dms])
+
+
+@app.route('/threads/<int:thread_id>/history')
+@user_id_only
+def thread_history(thread_id):
+    """A page of dms older than the 'before' cursor, oldest first, with the
+    cursor for the page before it (null at the start of the thread)."""
+    thread = Thread.query.get_or_404(thread_id)
+    if not thread.has_member(g.user_id):
+        return jsonify({'msg': 'Unauthorized'}), 403
+
+    dms, before = get_page_of_dms(thread)
+    return jsonify({'dms': [dm.serialize() for dm in dms], 'before': before})
+
+
+def get_page_of_dms(thread):
+    """Page of `thread`'s dms before the `before` cursor in the query
+    string, oldest first for display, and the cursor for the page before
+    it (or None)."""
+
+    dms, before = get_page(
+        lambda before, limit: DM.page(thread.dms, before, limit),
+        app.config['DMS_PER_PAGE'])
+
+    return dms[::-1], before
+
+
+@app.route('/threads/<int:thread_id>/stream')
+@user_id_only
+def stream_dms(thread_id):
+    """Server-Sent Events stream of new DMs in a thread.
+
+    Each event is a DM as JSON, with the DM id as the event id. On
+    reconnect, browsers send Last-Event-ID and we first replay what they
+    missed. Events without 'text' were too big to push; fetch them from
+    /threads/<id>/dms.
+
+    Needs an async worker (see Procfile) to hold many streams open.
+    """
+    thread = Thread.query.get_or_404(thread_id)
+    if not thread.has_member(g.user_id):
+        return jsonify({'msg': 'Unauthorized'}), 403
+
+    # subscribe before looking for missed DMs, so nothing falls in between
+    # (the client ignores ids it has already seen)
+    subscription = pubsub.subscribe(f"thread:{thread_id}")
+
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    missed = []
+    if last_id is not None:
+        missed = [dm.serialize() for dm in (DM
+                                            .query
+                                            .filter(DM.thread_id == thread_id,
+                                                    DM.id > last_id)
+                                            .order_by(DM.id)
+                                            .limit(app.config['DMS_PER_FETCH']))]
+
+    # an open stream shouldn't hold on to a DB connection
+    db.session.remove()
+    keepalive = app.config['STREAM_KEEPALIVE']
+
+    def events():
+        try:
+            # sends the headers right away, and sets the reconnect delay
+            yield "retry: 3000\n\n"
+
+            for dm in missed:
+                yield f"id: {dm['id']}\ndata: {json.dumps(dm)}\n\n"
+
+            while True:
+                dm = subscription.get(timeout=keepalive)
+                if dm is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"id: {dm['id']}\ndata: {json.dumps(dm)}\n\n"
+        finally:
+            subscription.close()
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--user-id', type=int, help="Only rebuild this user's timeline.")
+def rebuild_timelines(user_id):
+    """Backfill the precomputed home timelines."""
+
+    if user_id:
+        user_ids = [user_id]
+    else:
+        user_ids = [u.id for u in db.session.query(User.id)]
+
+    for uid in user_ids:
+        Timeline.rebuild(uid)
+        db.session.commit()
+
+    click.echo(f"Rebuilt {len(user_ids)} timeline(s).")
+
+
+@app.cli.command('trim-timelines')
+@click.option('--batch-size', type=int, default=1000,
+              help="Timelines to check per transaction.")
+def trim_timelines(batch_size):
+    """Cut timelines grown well past their length back down to it.
+
+    Posting doesn't trim, so run this periodically (say hourly).
+    """
+
+    user_ids = [uid for uid, in db.session.query(Timeline.user_id)]
+    trimmed = 0
+
+    for start in range(0, len(user_ids), batch_size):
+        trimmed += TimelineEntry.trim(user_ids[start:start + batch_size],
+                                      TIMELINE_SLACK)
+        db.session.commit()
+
+    click.echo(f"Trimmed {trimmed} of {len(user_ids)} timeline(s).")
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute the stored message/follow/reaction counts on users."""
+
+    User.repair_counters()
+    db.session.commit()
+
+    click.echo("Repaired user counters.")
+
+
+@app.cli.command('reconcile-reaction-counts')
+def reconcile_reaction_counts():
+    """Recompute the per-message reaction totals from the reactions."""
+
+    wrong = MessageReactionCount.reconcile()
     db.session.commit()
-    all_dms = [[dm.text, dm.author] for dm in thread.dms]
-    return jsonify(all_dms)
+
+    click.echo(f"Reconciled reaction counts ({wrong} were off).")
+
+
+@app.cli.command('backfill-threads')
+def backfill_threads():
+    """Recompute each thread's latest DM for the inbox."""
+
+    Thread.backfill_last_dm()
+    db.session.commit()
+
+    click.echo("Backfilled thread activity.")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """EXPLAIN the busiest pages' queries; fail if any scans a table."""
+
+    try:
+        problems = query_plans.check(app, CURR_USER_KEY)
+    except LookupError as e:
+        raise click.ClickException(str(e))
+
+    for path, statement, tables in problems:
+        click.echo(f"{path}: scans {', '.join(sorted(tables))}\n"
+                   f"    {' '.join(statement.split())}\n")
+
+    if problems:
+        raise click.ClickException(
+            f"{len(problems)} quer{'y' if len(problems) == 1 else 'ies'} "
+            f"without an index.")
+
+    click.echo("Every hot query uses an index.")
 
 
 ##############################################################################
@@ -0,0 +1,7 @@
+"""Performance benchmarks for Warbler.
+
+These run against a real (scratch!) Postgres database. Run them from the
+project root, like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.search_users
+"""
@@ -0,0 +1,179 @@
+"""Load test the DM stream endpoint with thousands of open streams.
+
+Opens --streams concurrent /threads/<id>/stream connections against a
+running server, sends --messages DMs into the thread, and reports how
+long connecting took and how long each DM took to reach every stream.
+
+Start the server on an async worker first, e.g.:
+
+    PUBSUB_BACKEND=postgres DATABASE_URL=postgresql:///warbler-bench \\
+        gunicorn app:app -k gevent --worker-connections 5000 -w 2 -b :8000
+
+then, with the same DATABASE_URL:
+
+    python -m benchmarks.dm_streams --url http://localhost:8000 --streams 3000
+
+This writes two users and a thread to the database: use a scratch one.
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from app import app, CURR_USER_KEY
+from models import db, User, Thread
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def get_or_create_user(username):
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        user = User.signup(username=username,
+                           email=f"{username}@example.com",
+                           password="benchmark",
+                           image_url=None)
+        db.session.commit()
+    return user
+
+
+def set_up_thread():
+    """Two bench users, a thread between them, and a session cookie each."""
+
+    with app.app_context():
+        reader = get_or_create_user('stream-bench-reader')
+        writer = get_or_create_user('stream-bench-writer')
+
+        thread_id = Thread.get_or_create_id(reader.id, writer.id)
+        db.session.commit()
+
+        serializer = app.session_interface.get_signing_serializer(app)
+
+        return (thread_id,
+                serializer.dumps({CURR_USER_KEY: reader.id}),
+                serializer.dumps({CURR_USER_KEY: writer.id}))
+
+
+async def open_stream(host, port, path, cookie, received, connected):
+    """Hold one stream open, noting when each DM text arrives."""
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((f"GET {path} HTTP/1.1\r\n"
+                  f"Host: {host}\r\n"
+                  f"Cookie: session={cookie}\r\n"
+                  f"Accept: text/event-stream\r\n\r\n").encode())
+
+    status = await reader.readline()
+    if b' 200 ' not in status:
+        raise RuntimeError(f"stream failed: {status!r}")
+
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+
+    connected.append(time.perf_counter() - start)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.startswith(b'data: '):
+                dm = json.loads(line[len(b'data: '):])
+                received.append((dm['text'], time.perf_counter()))
+    finally:
+        writer.close()
+
+
+async def send_dm(host, port, thread_id, cookie, text):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps({'text': text}).encode()
+    writer.write((f"POST /threads/{thread_id}/dm/add HTTP/1.1\r\n"
+                  f"Host: {host}\r\n"
+                  f"Cookie: session={cookie}\r\n"
+                  f"Content-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n"
+                  f"Connection: close\r\n\r\n").encode() + body)
+    await reader.read()
+    writer.close()
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    thread_id, reader_cookie, writer_cookie = set_up_thread()
+    path = f"/threads/{thread_id}/stream"
+
+    received = []
+    connected = []
+    streams = []
+
+    for _ in range(args.streams):
+        streams.append(asyncio.ensure_future(
+            open_stream(host, port, path, reader_cookie, received, connected)))
+        # don't SYN-flood the listen backlog
+        await asyncio.sleep(args.ramp / args.streams)
+
+    while len(connected) + sum(s.done() for s in streams) < args.streams:
+        await asyncio.sleep(0.1)
+
+    failed = sum(1 for s in streams if s.done())
+    print(f"streams open: {len(connected)}, failed: {failed}")
+    print(f"connect ms: p50 {percentile(connected, 50) * 1000:.1f} "
+          f"p99 {percentile(connected, 99) * 1000:.1f}")
+
+    sent_at = {}
+    for n in range(args.messages):
+        text = f"bench-{time.time()}-{n}"
+        sent_at[text] = time.perf_counter()
+        await send_dm(host, port, thread_id, writer_cookie, text)
+        await asyncio.sleep(args.interval)
+
+    expected = len(connected) * args.messages
+    deadline = time.perf_counter() + args.timeout
+    while len(received) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    latencies = [(at - sent_at[text]) * 1000
+                 for text, at in received if text in sent_at]
+
+    print(f"deliveries: {len(latencies)}/{expected}")
+    if latencies:
+        print(f"delivery ms: p50 {statistics.median(latencies):.1f} "
+              f"p95 {percentile(latencies, 95):.1f} "
+              f"p99 {percentile(latencies, 99):.1f} "
+              f"max {max(latencies):.1f}")
+
+    for stream in streams:
+        stream.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--streams', type=int, default=3000)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.25,
+                        help="seconds between DMs")
+    parser.add_argument('--ramp', type=float, default=10,
+                        help="seconds to spread stream connects over")
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    # one file descriptor per stream
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (min(hard, max(soft, args.streams + 100)), hard))
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Compare rendering a list of messages from ORM objects and read models.
+
+For each size in --sizes, loads that many messages (with their authors)
+as Message instances and as MessageRows, renders home.html with them,
+and reports the median load + render time and the peak memory
+allocated while doing it.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.read_models
+
+Tops the messages table up to the largest size with messages from a
+bench user, so point it at a scratch database.
+"""
+
+import argparse
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from flask import g, render_template
+from sqlalchemy.orm import selectinload
+
+from app import app
+from models import db, Message, MessageRow
+
+from benchmarks.dm_streams import get_or_create_user
+
+
+def fill_messages(count):
+    """Top the messages table up to `count` rows."""
+
+    have = Message.query.count()
+    if have >= count:
+        return
+
+    author = get_or_create_user('read-models-bench')
+    start = datetime(2018, 1, 1)
+
+    for first in range(have, count, 10000):
+        db.session.bulk_insert_mappings(Message, [
+            dict(text=f"bench message {n}", user_id=author.id,
+                 timestamp=start + timedelta(seconds=n))
+            for n in range(first, min(count, first + 10000))])
+        db.session.commit()
+
+
+def load_orm(size):
+    # the authors in one more query, as the pages loaded them before
+    # MessageRow
+    authors = (selectinload(Message.user)
+               .load_only('id', 'username', 'image_url'))
+    return Message.page(Message.query.options(authors), None, size)
+
+
+def load_rows(size):
+    return MessageRow.page(Message.query, None, size)
+
+
+def render(load, size):
+    """Load `size` messages with `load` and render them into home.html,
+    as a fresh request would (nothing in the identity map)."""
+
+    db.session.expunge_all()
+    messages = load(size)
+    html = render_template('home.html', messages=messages, reaction_types={},
+                           my_msgs=set(), reaction_counts={},
+                           next_cursor=None)
+    assert html.count('class="timeline-image"') == size
+
+
+def measure(load, size, repeat):
+    """(median ms, peak KiB allocated) for render(load, size)."""
+
+    render(load, size)  # warm up
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(load, size)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    render(load, size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return statistics.median(timings), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    with app.app_context():
+        fill_messages(max(args.sizes))
+        user = get_or_create_user('read-models-bench')
+
+    print(f"{'rows':>6} {'loaded as':<11} {'ms':>9} {'peak KiB':>10}")
+
+    for size in args.sizes:
+        for name, load in [('Message', load_orm), ('MessageRow', load_rows)]:
+            with app.test_request_context():
+                g.user = db.session.merge(user)
+                ms, kib = measure(load, size, args.repeat)
+
+            print(f"{size:>6} {name:<11} {ms:>9.2f} {kib:>10,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""Benchmark every page and endpoint, and catch regressions against a baseline.
+
+Optionally seeds a generated dataset (--seed-users and friends, run
+through generator/create_csvs.py and seed.py), then requests each of
+ROUTES --requests times as the user who follows the most people, and
+reports p50/p95/p99 latency, throughput and SQL queries per request.
+The writes come last and are varied so that every request does the
+work: posting, following and unfollowing in turn, toggling a reaction,
+logging in, and signing up a new user each time.
+
+Each route is driven twice over: through the Flask test client, and
+over HTTP through a real WSGI server (werkzeug's, threaded, started in
+this process) with --concurrency clients at once. Give --url to drive
+an already running server instead, e.g. gunicorn; queries per request
+can't be counted then, and the form posts (which need a CSRF token) are
+left out.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --seed-users 10000 --seed-messages 100000 --save baseline.json
+
+and after a change:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --compare baseline.json
+
+which exits non-zero if any route's p95 got more than --threshold
+(default 20%) slower, or it runs more queries per request than it did.
+Logins and signups turned away by the bcrypt pool (503) are reported as
+"busy" rather than failing the run.
+
+This writes to the database (seeding replaces everything in it): point
+it at a scratch one.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from werkzeug.serving import make_server
+
+from app import app, CURR_USER_KEY
+from models import db, Message, Thread, User
+import query_plans
+import seed
+
+from benchmarks.dm_streams import get_or_create_user, percentile
+
+BENCH_USER = 'routes-bench'
+BENCH_PASSWORD = 'benchmark'  # as get_or_create_user signs them up
+
+# users the follow route follows and unfollows in turn; request n goes to
+# target n % FOLLOW_TARGETS, so two requests only share a target (and
+# could race) if they're FOLLOW_TARGETS apart and in flight together
+FOLLOW_TARGETS = 32
+
+# a route to benchmark. `path` is formatted with the values from
+# sample_params(): user_id, username, thread_id, before, message_id and
+# follow_ids. `path`, `json` and `form` may instead be functions of the
+# request's number and those values, for writes that have to differ from
+# one request to the next. Anonymous routes are sent without the session
+# cookie (logging in or signing up would replace it).
+Route = namedtuple('Route', 'name method path json form anonymous',
+                   defaults=(None, None, False))
+
+
+def follow_path(n, params):
+    """Follow each target, then unfollow it on the next round."""
+
+    target = params['follow_ids'][n % len(params['follow_ids'])]
+    if (n // len(params['follow_ids'])) % 2 == 0:
+        return f"/users/follow/{target}"
+    return f"/users/stop-following/{target}"
+
+
+def toggle_reaction(n, params):
+    return {'ops': [{'msgId': params['message_id'], 'type': 'smile',
+                     'on': n % 2 == 0}]}
+
+
+def new_user(n, params):
+    username = f"{params['run']}-{n}"
+    return {'username': username, 'email': f"{username}@example.com",
+            'password': BENCH_PASSWORD, 'image_url': ''}
+
+
+ROUTES = [
+    Route('homepage', 'GET', '/'),
+    Route('list_users', 'GET', '/users'),
+    Route('search_users', 'GET', '/users?q={username}'),
+    Route('users_show', 'GET', '/users/{user_id}'),
+    Route('show_following', 'GET', '/users/{user_id}/following'),
+    Route('users_followers', 'GET', '/users/{user_id}/followers'),
+    Route('users_reactions', 'GET', '/users/{user_id}/reactions'),
+    Route('messages_show', 'GET', '/messages/{message_id}'),
+    Route('list_threads', 'GET', '/threads'),
+    Route('show_thread', 'GET', '/threads/{thread_id}'),
+    Route('list_dms', 'GET', '/threads/{thread_id}/dms?after=0'),
+    Route('thread_history', 'GET',
+          '/threads/{thread_id}/history?before={before}'),
+    Route('add_dm', 'POST', '/threads/{thread_id}/dm/add',
+          json={'text': "benchmark dm"}),
+    Route('messages_add', 'POST', '/messages/new',
+          form=lambda n, params: {'text': f"benchmark message {n}"}),
+    Route('follow', 'POST', follow_path),
+    Route('batch_reactions', 'POST', '/reactions/batch', json=toggle_reaction),
+    Route('login', 'POST', '/login',
+          form={'username': BENCH_USER, 'password': BENCH_PASSWORD},
+          anonymous=True),
+    Route('signup', 'POST', '/signup', form=new_user, anonymous=True),
+]
+
+# turned away by the bcrypt pool's admission control: counted, not failed
+BUSY = 503
+
+# requests per route before timing starts (caches, timelines, pools)
+WARM_UP = 5
+
+
+class QueryCounter:
+    """Counts the SQL statements run on the engine while it's attached."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        with self.lock:
+            self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self)
+
+
+def seed_dataset(args):
+    """Generate a dataset of the size asked for and load it."""
+
+    directory = tempfile.mkdtemp(prefix='warbler-bench-')
+    generator = os.path.join(os.path.dirname(seed.__file__),
+                             'generator', 'create_csvs.py')
+    subprocess.run(
+        [sys.executable, generator,
+         '--users', str(args.seed_users),
+         '--messages', str(args.seed_messages),
+         '--follows', str(args.seed_users * 20),
+         '--reactions', str(args.seed_messages * 3),
+         '--threads', str(args.seed_users),
+         '--dms', str(args.seed_users * 10),
+         '--out', directory],
+        check=True)
+
+    method = 'copy' if db.engine.dialect.name == 'postgresql' else 'insert'
+    seed.seed(directory, method)
+
+
+def sample_params():
+    """query_plans' sample user and thread (starting a thread with the
+    bench user if they have none), plus one of their messages, users to
+    follow and a prefix for signups unique to this run."""
+
+    params = query_plans.sample_params()
+    if params['thread_id'] is None:
+        other = get_or_create_user(BENCH_USER)
+        Thread.get_or_create_id(params['user_id'], other.id)
+        db.session.commit()
+        params = query_plans.sample_params()
+
+    message = (Message
+               .query
+               .filter_by(user_id=params['user_id'])
+               .order_by(Message.id.desc())
+               .first() or Message.query.first())
+    params['message_id'] = message.id if message else 0
+
+    # logging in needs a password we know
+    get_or_create_user(BENCH_USER)
+
+    follow_ids = [user_id for user_id, in db.session
+                  .query(User.id)
+                  .filter(User.id != params['user_id'])
+                  .order_by(User.id)
+                  .limit(FOLLOW_TARGETS)]
+    for n in range(len(follow_ids), FOLLOW_TARGETS):
+        follow_ids.append(get_or_create_user(f"routes-bench-{n}").id)
+    params['follow_ids'] = follow_ids
+
+    params['run'] = f"bench{int(time.time())}"
+    return params
+
+
+def session_cookie(user_id):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+def build_request(route, n, params):
+    """(path, body, content type) for request number `n` of `route`."""
+
+    def value(field):
+        return field(n, params) if callable(field) else field
+
+    if callable(route.path):
+        path = route.path(n, params)
+    else:
+        path = route.path.format(**params)
+
+    if route.json is not None:
+        return path, json.dumps(value(route.json)).encode(), 'application/json'
+    if route.form is not None:
+        return (path, urllib.parse.urlencode(value(route.form)).encode(),
+                'application/x-www-form-urlencoded')
+    return path, None, None
+
+
+def test_client_request(client):
+    def request(route, n, params):
+        path, body, content_type = build_request(route, n, params)
+        # a client of its own: no session cookie, and none kept after
+        sender = app.test_client() if route.anonymous else client
+        resp = sender.open(path, method=route.method, data=body,
+                           content_type=content_type)
+        return resp.status_code
+
+    return request
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Time just the request asked for, not the page it redirects to."""
+
+    def redirect_request(self, *args):
+        return None
+
+
+def http_request(url, cookie):
+    opener = urllib.request.build_opener(NoRedirects)
+
+    def request(route, n, params):
+        path, body, content_type = build_request(route, n, params)
+        headers = {} if route.anonymous else {'Cookie': f"session={cookie}"}
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        req = urllib.request.Request(url + path, method=route.method,
+                                     data=body, headers=headers)
+        try:
+            with opener.open(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            # redirects and errors alike
+            return e.code
+
+    return request
+
+
+# each route's next request number, carried on from one driver to the
+# next so alternating writes (follow, then unfollow) stay in step
+request_numbers = defaultdict(itertools.count)
+
+
+def measure(request, route, params, count, concurrency):
+    """Send `count` requests, `concurrency` at a time; returns
+    (latencies in ms, seconds taken, requests turned away as busy)."""
+
+    numbers = request_numbers[route.name]
+
+    for _ in range(WARM_UP):
+        request(route, next(numbers), params)
+
+    def timed(_):
+        start = time.perf_counter()
+        status = request(route, next(numbers), params)
+        if status >= 400 and status != BUSY:
+            raise RuntimeError(f"{route.method} {route.name} returned "
+                               f"{status}")
+        return (time.perf_counter() - start) * 1000, status == BUSY
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        results = [timed(n) for n in range(count)]
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(timed, range(count)))
+
+    latencies = [ms for ms, busy in results]
+    return (latencies, time.perf_counter() - start,
+            sum(busy for ms, busy in results))
+
+
+def run_routes(driver, request, params, args, count_queries):
+    results = {}
+
+    for route in ROUTES:
+        concurrency = 1 if driver == 'test_client' else args.concurrency
+
+        with QueryCounter() as counter:
+            latencies, elapsed, busy = measure(request, route, params,
+                                               args.requests, concurrency)
+
+        result = {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'qps': len(latencies) / elapsed,
+            # the warm-up requests ran with the counter attached too
+            'queries': (counter.count / (args.requests + WARM_UP)
+                        if count_queries else None),
+            'busy': busy / len(latencies),
+        }
+        results[f"{driver} {route.name}"] = result
+        print_result(f"{driver} {route.name}", result)
+
+    return results
+
+
+def print_result(key, result):
+    queries = ('' if result['queries'] is None
+               else f"{result['queries']:.1f}")
+    busy = f"{result['busy']:.0%}" if result.get('busy') else ''
+    print(f"{key:<32} {result['p50']:>8.2f} {result['p95']:>8.2f} "
+          f"{result['p99']:>8.2f} {result['qps']:>8.1f} {queries:>8} "
+          f"{busy:>6}")
+
+
+def regressions(baseline, results, threshold):
+    """Descriptions of the routes in `results` doing worse than in
+    `baseline`: p95 more than `threshold` (a fraction) slower, or more
+    queries per request."""
+
+    found = []
+
+    for key, result in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+
+        if result['p95'] > old['p95'] * (1 + threshold):
+            found.append(f"{key}: p95 {old['p95']:.2f} -> "
+                         f"{result['p95']:.2f} ms")
+
+        if (result['queries'] is not None and old['queries'] is not None
+                and result['queries'] > old['queries'] + 0.5):
+            found.append(f"{key}: queries {old['queries']:.1f} -> "
+                         f"{result['queries']:.1f}")
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seed-users', type=int, default=0,
+                        help="generate and load a dataset this size first")
+    parser.add_argument('--seed-messages', type=int, default=0,
+                        help="defaults to 10 per seeded user")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="timed requests per route, per driver")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="clients at once against the WSGI server")
+    parser.add_argument('--url',
+                        help="drive this running server instead of "
+                             "starting one")
+    parser.add_argument('--routes', nargs='+',
+                        help="only these routes (by view name)")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON to check against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="p95 slowdown allowed, as a fraction")
+    args = parser.parse_args()
+
+    if args.routes:
+        ROUTES[:] = [route for route in ROUTES if route.name in args.routes]
+
+    with app.app_context():
+        if args.seed_users:
+            args.seed_messages = args.seed_messages or args.seed_users * 10
+            seed_dataset(args)
+        params = sample_params()
+
+    if db.engine.dialect.name != 'postgresql':
+        # substring search is a full scan without pg_trgm
+        ROUTES[:] = [route for route in ROUTES if route.name != 'search_users']
+
+    cookie = session_cookie(params['user_id'])
+    client = app.test_client()
+    client.set_cookie('localhost', 'session', cookie)
+
+    # the forms are posted without CSRF tokens
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    print(f"{'route':<32} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'req/s':>8} {'queries':>8} {'busy':>6}")
+
+    results = run_routes('test_client', test_client_request(client),
+                         params, args, count_queries=True)
+
+    if args.url:
+        # a server we didn't start still wants CSRF tokens on its forms
+        ROUTES[:] = [route for route in ROUTES if route.form is None]
+        results.update(run_routes('http', http_request(args.url, cookie),
+                                  params, args, count_queries=False))
+    else:
+        # one access log line per request would drown the results
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}"
+            results.update(run_routes('http', http_request(url, cookie),
+                                      params, args, count_queries=True))
+        finally:
+            server.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(json.load(f), results, args.threshold)
+        for problem in found:
+            print(f"REGRESSION {problem}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark /users?q= search latency on a large users table.
+
+Fills the users table up to --users rows (default 1M) with generated
+usernames, then times `User.search` against the old unindexed
+`username LIKE '%term%'` query for a handful of terms.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.search_users
+
+This writes to the database: point it at a scratch one.
+"""
+
+import argparse
+import statistics
+import time
+
+from app import app
+from models import (db, User, PG_TRGM_EXTENSION, USERNAME_TRGM_INDEX,
+                    USERNAME_PREFIX_INDEX)
+
+TERMS = ['user123456', 'user12', 'r99', 'us', 'zzz-no-match']
+
+
+def fill_users(count):
+    """Top the users table up to `count` rows, in SQL."""
+
+    have = User.query.count()
+    if have >= count:
+        return
+
+    db.session.execute(
+        """INSERT INTO users (email, username, password)
+           SELECT 'bench' || n || '@example.com', 'user' || n, 'x'
+           FROM generate_series(:start, :stop) AS n""",
+        {'start': have + 1, 'stop': count})
+    db.session.execute(PG_TRGM_EXTENSION)
+    db.session.execute(USERNAME_TRGM_INDEX)
+    db.session.execute(USERNAME_PREFIX_INDEX)
+    db.session.commit()
+    db.session.execute("ANALYZE users")
+
+
+def time_it(fn, repeat):
+    """Run `fn` `repeat` times; return sorted latencies in ms."""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=48)
+    args = parser.parse_args()
+
+    fill_users(args.users)
+
+    print(f"{'term':<14} {'query':<10} {'p50 ms':>9} {'p95 ms':>9}")
+
+    for term in TERMS:
+        def indexed():
+            User.search(term, args.limit)
+
+        def unindexed():
+            (User
+             .query
+             .filter(User.username.like(f"%{term}%"))
+             .limit(args.limit)
+             .all())
+
+        for name, fn in [('search', indexed), ('old like', unindexed)]:
+            fn()  # warm up
+            timings = time_it(fn, args.repeat)
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            print(f"{term:<14} {name:<10} "
+                  f"{statistics.median(timings):>9.2f} {p95:>9.2f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -0,0 +1,77 @@
+"""Benchmark first paint of a DM thread as the thread grows.
+
+Grows one thread to each size in --sizes and times GET /threads/<id>
+through the Flask test client. Only the latest DMS_PER_PAGE DMs are
+rendered, so the times should stay flat from 100 to 100k DMs.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.thread_history
+
+This writes to the database: point it at a scratch one.
+"""
+
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from app import app, CURR_USER_KEY
+from models import db, Thread, DM
+
+from benchmarks.dm_streams import get_or_create_user, percentile
+
+
+def grow_thread(thread, size):
+    """Add DMs (a second apart) until `thread` has `size` of them."""
+
+    have = thread.dms.count()
+    start = datetime(2018, 1, 1)
+    authors = [thread.user1_id, thread.user2_id]
+
+    for first in range(have, size, 10000):
+        db.session.bulk_insert_mappings(DM, [
+            dict(text=f"dm {n}", thread_id=thread.id, author=authors[n % 2],
+                 timestamp=start + timedelta(seconds=n))
+            for n in range(first, min(size, first + 10000))])
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+        user1 = get_or_create_user('history-bench-1')
+        user2 = get_or_create_user('history-bench-2')
+        thread_id = Thread.get_or_create_id(user1.id, user2.id)
+        db.session.commit()
+        user_id = user1.id
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    print(f"{'dms':>8} {'p50 ms':>9} {'p95 ms':>9}")
+
+    for size in args.sizes:
+        with app.app_context():
+            grow_thread(Thread.query.get(thread_id), size)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            resp = client.get(f'/threads/{thread_id}')
+            timings.append((time.perf_counter() - start) * 1000)
+            assert resp.status_code == 200
+
+        print(f"{size:>8} {statistics.median(timings):>9.2f} "
+              f"{percentile(timings, 95):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,76 +2,287 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a load testing set:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --reactions 20000000 --threads 2000000 \\
+        --dms 40000000 --processes 8 --out /tmp/warbler-big
+
+and then `python seed.py --dir /tmp/warbler-big`.
+
+Works offline, and the same --seed (and --end, which defaults to a fixed
+date) gives the same files whatever the --processes or the day. Rows are written as they're made, a chunk of entities per
+task, so memory stays flat however big the set. Who gets followed, and
+who posts, follow a power law: a few users are hugely popular and most
+have a handful of followers. Per-user follows, per-message reactions and
+per-thread DMs are lognormally spread around the averages asked for.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+import shutil
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from math import gcd
+from multiprocessing import Pool
 
-MAX_WARBLER_LENGTH = 140
+from helpers import (WORDS, unit_hash, power_law_rank, heavy_tailed_count,
+                     sentence)
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+MAX_WARBLER_LENGTH = 140
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# newest date generated unless --end says otherwise; not today's, which
+# would change the files from one day to the next
+DEFAULT_END = date(2019, 1, 1)
 
-fake = Faker()
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+REACTIONS_CSV_HEADERS = ['user_id', 'message_id', 'reaction_type']
+THREADS_CSV_HEADERS = ['id', 'user1_id', 'user2_id']
+DMS_CSV_HEADERS = ['text', 'timestamp', 'thread_id', 'author']
 
-# Generate random profile image URLs to use for users
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
 
-# Generate random header image URLs to use for users
+REACTION_TYPES = ['smile', 'sad', 'laugh', 'angry']
+
+# entities (users, messages or threads) generated per task
+CHUNK_SIZE = 10000
+
+# streams for unit_hash, so different uses don't share values
+AUTHOR, FOLLOWEE = 1, 2
+
+
+class Generator:
+    """Makes the rows for one chunk of one table, from the settings alone."""
+
+    def __init__(self, args):
+        self.args = args
+        self.end = datetime.combine(args.end, datetime.min.time())
+        # maps popularity rank -> user id, scattered so user 1 isn't the
+        # most popular; any multiplier coprime with the user count is a
+        # bijection
+        self.scatter = max(1, int(args.users * 0.6180339887))
+        while gcd(self.scatter, args.users) != 1:
+            self.scatter += 1
+
+    def rng(self, table, chunk):
+        return random.Random(f"{self.args.seed}:{table}:{chunk}")
+
+    def popular_user(self, u, exponent):
+        rank = power_law_rank(u, self.args.users, exponent)
+        return (rank - 1) * self.scatter % self.args.users + 1
+
+    def author(self, message_id):
+        """Who wrote `message_id` (the same answer in every process)."""
+
+        return self.popular_user(
+            unit_hash(self.args.seed, AUTHOR, message_id),
+            self.args.author_exponent)
+
+    def timestamp(self, rng):
+        return self.end - timedelta(seconds=rng.uniform(0, self.args.days * 86400))
+
+    def ids(self, chunk, total):
+        return range(chunk * CHUNK_SIZE + 1,
+                     min(total, (chunk + 1) * CHUNK_SIZE) + 1)
+
+    def users(self, chunk):
+        rng = self.rng('users', chunk)
+
+        for user_id in self.ids(chunk, self.args.users):
+            username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+            yield [user_id, f"{username}@example.com", username,
+                   rng.choice(IMAGE_URLS), PASSWORD,
+                   sentence(rng, MAX_WARBLER_LENGTH), HEADER_IMAGE_URL,
+                   rng.choice(WORDS).capitalize()]
+
+    def messages(self, chunk):
+        rng = self.rng('messages', chunk)
+
+        for message_id in self.ids(chunk, self.args.messages):
+            yield [message_id, sentence(rng, MAX_WARBLER_LENGTH),
+                   self.timestamp(rng), self.author(message_id)]
+
+    def follows(self, chunk):
+        rng = self.rng('follows', chunk)
+        mean = self.args.follows / self.args.users
+        most = (self.args.users - 1) // 2
+
+        for user_id in self.ids(chunk, self.args.users):
+            following = set()
+
+            for n in range(min(most, heavy_tailed_count(rng, mean))):
+                # draws can repeat, so bound the tries rather than loop
+                for attempt in range(10):
+                    followee = self.popular_user(
+                        unit_hash(self.args.seed, FOLLOWEE, user_id, n, attempt),
+                        self.args.follow_exponent)
+                    if followee != user_id and followee not in following:
+                        following.add(followee)
+                        break
+
+            # in this schema, followee_id is the user doing the following
+            for followee in sorted(following):
+                yield [user_id, followee]
+
+    def reactions(self, chunk):
+        rng = self.rng('reactions', chunk)
+        mean = self.args.reactions / max(1, self.args.messages)
+
+        for message_id in self.ids(chunk, self.args.messages):
+            author = self.author(message_id)
+            count = min(self.args.users - 1, heavy_tailed_count(rng, mean))
+            reactors = set()
+
+            while len(reactors) < count:
+                user_id = rng.randint(1, self.args.users)
+                if user_id != author:
+                    reactors.add(user_id)
+
+            for user_id in sorted(reactors):
+                yield [user_id, message_id, rng.choice(REACTION_TYPES)]
+
+    def thread_pairs(self, chunk):
+        """(user1_id, user2_id) of this chunk's threads.
+
+        Each user starts threads only with higher user ids, so no pair
+        comes up twice.
+        """
+
+        rng = self.rng('threads', chunk)
+        mean = self.args.threads / self.args.users
+
+        for user_id in self.ids(chunk, self.args.users):
+            others = self.args.users - user_id
+            count = min(others, heavy_tailed_count(rng, mean))
+            partners = set()
+
+            while len(partners) < count:
+                partners.add(user_id + rng.randint(1, others))
+
+            for partner in sorted(partners):
+                yield user_id, partner
+
+    def threads(self, chunk, first_id):
+        for thread_id, pair in enumerate(self.thread_pairs(chunk), first_id):
+            yield [thread_id, *pair]
+
+    def dms(self, chunk, first_id):
+        rng = self.rng('dms', chunk)
+        mean = self.args.dms / max(1, self.args.threads)
+
+        for thread_id, pair in enumerate(self.thread_pairs(chunk), first_id):
+            timestamp = self.timestamp(rng)
+
+            for n in range(heavy_tailed_count(rng, mean)):
+                timestamp += timedelta(seconds=rng.expovariate(1 / 600))
+                yield [sentence(rng, MAX_WARBLER_LENGTH), timestamp,
+                       thread_id, rng.choice(pair)]
+
+
+def count_threads(args, chunk):
+    return sum(1 for _ in Generator(args).thread_pairs(chunk))
+
+
+def write_part(args, table, chunk, *extra):
+    """Write one chunk of `table` to its part file; returns the row count."""
+
+    rows = getattr(Generator(args), table)(chunk, *extra)
+    path = part_path(args, table, chunk)
+    count = 0
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+
+    return count
+
+
+def part_path(args, table, chunk):
+    return os.path.join(args.out, 'parts', f"{table}.{chunk:06}.csv")
+
+
+def run(pool, args, table, total, headers, extras=None):
+    """Generate `table` in chunks on `pool`, then join the parts in order
+    into one CSV. Returns the row count of each chunk."""
+
+    chunks = range((total + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    tasks = [(args, table, chunk) + ((extras[chunk],) if extras else ())
+             for chunk in chunks]
+    counts = pool.starmap(write_part, tasks)
+
+    with open(os.path.join(args.out, f"{table}.csv"), 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+        for chunk in chunks:
+            with open(part_path(args, table, chunk)) as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path(args, table, chunk))
+
+    print(f"{table:<10} {sum(counts):>12,} rows")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="roughly; the follow graph is random")
+    parser.add_argument('--reactions', type=int, default=3000,
+                        help="roughly")
+    parser.add_argument('--threads', type=int, default=300, help="roughly")
+    parser.add_argument('--dms', type=int, default=3000, help="roughly")
+    parser.add_argument('--days', type=int, default=730,
+                        help="spread messages over this many days")
+    parser.add_argument('--end', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(),
+                        default=DEFAULT_END,
+                        help="newest date to generate (YYYY-MM-DD); fixed "
+                             "by default, so a seed gives the same files "
+                             "on any day")
+    parser.add_argument('--follow-exponent', type=float, default=1.1,
+                        help="power law exponent for who gets followed")
+    parser.add_argument('--author-exponent', type=float, default=0.8,
+                        help="power law exponent for who posts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.out, 'parts'), exist_ok=True)
+
+    with Pool(args.processes) as pool:
+        run(pool, args, 'users', args.users, USERS_CSV_HEADERS)
+        run(pool, args, 'messages', args.messages, MESSAGES_CSV_HEADERS)
+        run(pool, args, 'follows', args.users, FOLLOWS_CSV_HEADERS)
+        run(pool, args, 'reactions', args.messages, REACTIONS_CSV_HEADERS)
+
+        # thread ids run on from one chunk to the next, so count each
+        # chunk's threads first to know where its ids start
+        chunks = range((args.users + CHUNK_SIZE - 1) // CHUNK_SIZE)
+        counts = pool.starmap(count_threads, [(args, c) for c in chunks])
+        first_ids = [1 + n for n in [0, *accumulate(counts)][:-1]]
+
+        run(pool, args, 'threads', args.users, THREADS_CSV_HEADERS,
+            extras=first_ids)
+        run(pool, args, 'dms', args.users, DMS_CSV_HEADERS, extras=first_ids)
+
+    os.rmdir(os.path.join(args.out, 'parts'))
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,107 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
 
+WORDS = """
+    able about above across act add after again against age ago agree air
+    all almost alone along already also always among and animal another
+    answer any appear area arm around art ask at away baby back bad bag ball
+    bank base be bear beat beautiful because become bed before begin behind
+    best better between big bird bit black blood blue board boat body book
+    born both box boy break bring brother build burn business but buy call
+    can car card care carry case cat catch cause center century certain
+    chair chance change charge check child choice choose church city class
+    clear close coach cold collection college color come common community
+    company cost could country course court cover create cup cut dark data
+    daughter day dead deal deep degree describe design detail develop die
+    difference dinner direction discover discuss do doctor dog door down
+    draw dream drive drop during each early east easy eat edge effect egg
+    eight either else end energy enjoy enough enter entire even evening
+    event ever every evidence exactly example expect experience explain eye
+    face fact fall family far fast father fear feel few field fight figure
+    fill film final find fine finish fire firm first fish five floor fly
+    follow food foot for force forget form forward four free friend from
+    front full fun game garden gas general get girl give glass go goal good
+    great green ground group grow guess gun guy hair half hand hang happen
+    happy hard have he head hear heart heat heavy help her here high hill
+    history hit hold home hope horse hot hotel hour house huge human idea
+    image imagine important in inside interest into island it itself job
+    join just keep key kid kind kitchen know lake land language large last
+    late laugh lead learn least leave left leg less letter level life light
+    like line list listen little live local long look lose lot love low
+    machine magazine main make man many map market matter may meet member
+    memory message middle might mind minute miss modern moment money month
+    more morning most mother mountain move movie much music must name
+    nation nature near need never new news next nice night nine no north
+    note nothing notice now number ocean off offer office often oil old on
+    once one only open or order other out over own page paint paper parent
+    park part party pass past pay peace people perfect person phone picture
+    piece place plan plant play please point police poor popular positive
+    power practice prepare present pretty price problem produce program
+    pull push put question quick quite race radio rain raise reach read
+    ready real reason red remember rest rich ride right river road rock
+    room rule run safe sail salt same save say school science sea season
+    seat second see sell send serve set seven shake share ship shoe shop
+    short show side sign simple sing sister sit six size skill sky sleep
+    slow small smile snow so soft some son song soon sound south space
+    speak special spend sport spring stand star start state stay step still
+    stone stop store story street strong student study style success summer
+    sun sure surface table take talk tall teach team tell ten test thank
+    that the then there these thing think this three through throw time
+    today together tonight too top total touch town trade travel tree trip
+    true try turn two under until up use usually value very view visit
+    voice wait walk wall want war warm wash watch water wave way wear
+    weather week weight well west what wheel when where which while white
+    whole why wide wife will win wind window winter wish with without woman
+    wonder wood word work world worry write wrong yard year yellow yes yet
+    young
+""".split()
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+MASK64 = (1 << 64) - 1
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def unit_hash(*keys):
+    """A float in [0, 1) that depends only on `keys` (integers).
+
+    SplitMix64 over the keys, so any process can work out the same
+    "random" value for, say, a message's author without sharing state.
+    """
+
+    z = 0x9E3779B97F4A7C15
+    for key in keys:
+        z = (z ^ key) * 0xBF58476D1CE4E5B9 & MASK64
+        z = (z ^ (z >> 27)) * 0x94D049BB133111EB & MASK64
+        z ^= z >> 31
+
+    return (z >> 11) / (1 << 53)
+
+
+def power_law_rank(u, n, exponent):
+    """Turn uniform `u` into a rank in 1..n with P(rank) ~ rank^-exponent."""
+
+    if exponent == 1:
+        rank = n ** u
+    else:
+        rank = ((n ** (1 - exponent) - 1) * u + 1) ** (1 / (1 - exponent))
+
+    return min(n, int(rank))
+
+
+def heavy_tailed_count(rng, mean, sigma=1.0):
+    """A non-negative count, lognormally spread around `mean`."""
+
+    if mean <= 0:
+        return 0
+
+    value = rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+    # round up or down at random, so small means still average out
+    return int(value) + (rng.random() < value % 1)
+
+
+def sentence(rng, max_length):
+    """A run of random words, capitalised, at most `max_length` chars."""
+
+    text = ' '.join(rng.choice(WORDS)
+                    for _ in range(rng.randint(4, 20))).capitalize()
+
+    return text[:max_length - 1].rstrip() + '.'
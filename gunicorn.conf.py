@@ -0,0 +1,36 @@
+"""gunicorn settings shared by the Procfile's processes.
+
+    gunicorn app:app -c gunicorn.conf.py
+
+Sets up prometheus_client's multiprocess mode, so /metrics adds up every
+worker's metrics rather than showing whichever worker answered: each
+worker writes its values to files in prometheus_multiproc_dir, which is
+emptied when gunicorn starts, and a dead worker's live gauges are
+dropped when it exits.
+"""
+
+import os
+import shutil
+import tempfile
+
+# read by prometheus_client when the workers import it, so it has to be
+# set here, in the master, before they start. One per master by default:
+# the web and stream processes each add up only their own workers.
+multiproc_dir = (os.environ.get('PROMETHEUS_MULTIPROC_DIR') or
+                 os.environ.get('prometheus_multiproc_dir') or
+                 os.path.join(tempfile.gettempdir(),
+                              f"warbler-metrics-{os.getpid()}"))
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = multiproc_dir
+os.environ['prometheus_multiproc_dir'] = multiproc_dir
+
+
+def on_starting(server):
+    # values left over from an earlier run would be added in
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
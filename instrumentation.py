@@ -0,0 +1,163 @@
+"""Per-request SQL query counts and timings, always on.
+
+Listens to the engine's cursor events to count each request's queries
+and the time spent in them, then:
+
+- adds a Server-Timing header, e.g.
+  `db;dur=12.4;desc="7 queries", app;dur=30.1`, which the browser's
+  network panel shows against each request;
+
+- logs (as a warning on the "instrumentation" logger) any request that
+  takes longer than SLOW_REQUEST_MS or runs more than
+  SLOW_REQUEST_QUERIES queries, with its statements grouped by
+  fingerprint (the SQL with its values taken out), most expensive first.
+  An N+1 shows up as one fingerprint run N times.
+
+The per-query cost is two perf_counter() calls and a list append; the
+statements are only fingerprinted for requests that get logged. That
+measured ~1.3µs a query, so a request pays about 1.3µs times its query
+count: past 1% only if it spends under ~130µs per query all told (ORM
+and rendering included). On the SQLite bench set from
+benchmarks/routes.py the busiest pages run 1-8 queries in 3-20ms, well
+under that.
+"""
+
+import logging
+import re
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# literals and bound parameters (psycopg2's %(name)s and SQLite's ?)
+VALUES = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|\?")
+VALUE_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """`statement` with its values replaced by ?, lists of values (as in
+    IN (...)) collapsed and whitespace normalised, so the same query with
+    different values gets the same fingerprint."""
+
+    statement = VALUES.sub('?', statement)
+    statement = VALUE_LISTS.sub('(?, ...)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryStats:
+    """The queries run during one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # (statement, seconds) for each query
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def db_seconds(self):
+        return sum(seconds for statement, seconds in self.queries)
+
+    def by_fingerprint(self):
+        """[(fingerprint, times run, total seconds), ...], most total time
+        first."""
+
+        totals = {}
+        for statement, seconds in self.queries:
+            key = fingerprint(statement)
+            count, total = totals.get(key, (0, 0))
+            totals[key] = (count + 1, total + seconds)
+
+        return sorted(((key, count, total)
+                       for key, (count, total) in totals.items()),
+                      key=lambda row: row[2], reverse=True)
+
+
+class Instrumentation:
+    """Wires QueryStats up to a Flask app and its SQLAlchemy engine."""
+
+    def __init__(self):
+        # the request being served on this thread (or greenlet, under
+        # gevent's monkey-patching), if any
+        self.local = threading.local()
+
+    def init_app(self, app, engine):
+        """Start counting. Call this before registering other
+        before_request functions, so their queries count too."""
+
+        app.config.setdefault('SLOW_REQUEST_MS', 500)
+        app.config.setdefault('SLOW_REQUEST_QUERIES', 50)
+        app.config.setdefault('SERVER_TIMING', True)
+
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.forget_request)
+        self.app = app
+
+    @property
+    def current(self):
+        """Stats for the request being served here, or None."""
+
+        return getattr(self.local, 'stats', None)
+
+    def start_request(self):
+        self.local.stats = QueryStats()
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if context is not None:
+            context._instrumentation_start = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        stats = self.current
+        if stats is None or context is None:
+            return
+
+        start = getattr(context, '_instrumentation_start', None)
+        if start is not None:
+            stats.queries.append((statement, time.perf_counter() - start))
+
+    def finish_request(self, response):
+        stats = self.current
+        if stats is None:
+            return response
+
+        elapsed_ms = (time.perf_counter() - stats.start) * 1000
+        db_ms = stats.db_seconds * 1000
+        config = self.app.config
+
+        if config['SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={db_ms:.1f};desc="{stats.count} queries", '
+                f'app;dur={elapsed_ms - db_ms:.1f}')
+
+        if (elapsed_ms > config['SLOW_REQUEST_MS'] or
+                stats.count > config['SLOW_REQUEST_QUERIES']):
+            self.log_slow_request(stats, elapsed_ms, db_ms)
+
+        return response
+
+    def forget_request(self, exc):
+        self.local.stats = None
+
+    def log_slow_request(self, stats, elapsed_ms, db_ms):
+        lines = [f"slow request: {request.method} "
+                 f"{request.full_path.rstrip('?')} "
+                 f"{elapsed_ms:.0f}ms, {stats.count} queries "
+                 f"({db_ms:.0f}ms in the db)"]
+
+        for key, count, seconds in stats.by_fingerprint():
+            lines.append(f"  {count:>4} x {seconds * 1000:>8.1f}ms  {key}")
+
+        logger.warning('\n'.join(lines))
@@ -0,0 +1,127 @@
+"""Prometheus metrics, served at /metrics.
+
+- warbler_request_seconds: latency histogram by route (the view's name),
+  method and status
+- warbler_requests_in_progress: requests being served right now
+- warbler_db_pool_*: connections checked out of / overflowing the
+  SQLAlchemy pool, and checkouts and new connections made
+- warbler_user_cache_total: logged-in user cache hits and misses
+- warbler_bcrypt_seconds: time spent hashing passwords (see passwords.py)
+
+Under gunicorn each worker is its own process with its own metrics, so
+gunicorn.conf.py points prometheus_multiproc_dir at a directory they all
+write their values to, and /metrics adds them up from there (gauges
+count only live workers). Without that setting, as with `flask run`,
+this process's own values are served.
+"""
+
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, CONTENT_TYPE_LATEST, generate_latest)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+
+REQUEST_SECONDS = Histogram(
+    'warbler_request_seconds',
+    "Time taken to serve a request, by route, method and status.",
+    ['route', 'method', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+REQUESTS_IN_PROGRESS = Gauge(
+    'warbler_requests_in_progress',
+    "Requests being served.",
+    multiprocess_mode='livesum')
+
+POOL_CHECKED_OUT = Gauge(
+    'warbler_db_pool_checked_out',
+    "Database connections checked out of the pool.",
+    multiprocess_mode='livesum')
+
+POOL_OVERFLOW = Gauge(
+    'warbler_db_pool_overflow',
+    "Connections open beyond the pool's size (negative: room left in it).",
+    multiprocess_mode='livesum')
+
+POOL_CHECKOUTS = Counter(
+    'warbler_db_pool_checkouts_total',
+    "Connections checked out of the pool.")
+
+POOL_CONNECTS = Counter(
+    'warbler_db_pool_connects_total',
+    "New database connections opened by the pool.")
+
+USER_CACHE = Counter(
+    'warbler_user_cache_total',
+    "Lookups of the logged-in user's row, by result (hit or miss).",
+    ['result'])
+
+
+def multiprocess_dir():
+    return (os.environ.get('PROMETHEUS_MULTIPROC_DIR') or
+            os.environ.get('prometheus_multiproc_dir'))
+
+
+def registry():
+    """What /metrics serves: every worker's values if they're shared
+    through a multiprocess directory, else this process's."""
+
+    if not multiprocess_dir():
+        return REGISTRY
+
+    combined = CollectorRegistry()
+    multiprocess.MultiProcessCollector(combined)
+    return combined
+
+
+def init_app(app, engine):
+    """Time app's requests, watch engine's pool, and add /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_in_progress = True
+        REQUESTS_IN_PROGRESS.inc()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            REQUEST_SECONDS.labels(
+                request.endpoint or 'none', request.method,
+                response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        if g.pop('metrics_in_progress', False):
+            REQUESTS_IN_PROGRESS.dec()
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(registry()),
+                        mimetype=CONTENT_TYPE_LATEST)
+
+    pool = engine.pool
+
+    def pool_changed():
+        # only QueuePool (Postgres) has a size to overflow
+        if hasattr(pool, 'overflow'):
+            POOL_OVERFLOW.set(pool.overflow())
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        POOL_CONNECTS.inc()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.inc()
+        POOL_CHECKED_OUT.inc()
+        pool_changed()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        POOL_CHECKED_OUT.dec()
+        pool_changed()
@@ -0,0 +1,99 @@
+"""server-side timestamps
+
+Messages and DMs used to be stamped with `datetime.utcnow()` evaluated
+once, when models.py was imported, so every row a worker inserted got
+its start-up time. They're now stamped by the database.
+
+On Postgres this also backfills the rows that got the same stale
+timestamp: within each group of tied rows, later ids are moved forward
+a microsecond at a time, so time order matches insert order. The
+timeline and thread copies of those timestamps are brought in line.
+
+The messages (user_id, timestamp) index is replaced by one on
+(user_id, timestamp DESC, id DESC), the order the feed reads in.
+
+Revision ID: 29b100121e27
+Revises: b9e94af8a2b3
+Create Date: 2026-10-18 03:12:40.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '29b100121e27'
+down_revision = 'b9e94af8a2b3'
+branch_labels = None
+depends_on = None
+
+
+UTCNOW = {
+    'postgresql': "TIMEZONE('utc', CURRENT_TIMESTAMP)",
+    'sqlite': "(STRFTIME('%Y-%m-%d %H:%M:%f', 'now'))",
+}
+
+SPREAD_TIES = """
+    UPDATE {table} AS t
+    SET timestamp = t.timestamp + tied.n * INTERVAL '1 microsecond'
+    FROM (SELECT id,
+                 ROW_NUMBER() OVER (PARTITION BY timestamp ORDER BY id) - 1
+                     AS n
+          FROM {table}) AS tied
+    WHERE t.id = tied.id AND tied.n > 0
+"""
+
+SYNC_TIMELINE_ENTRIES = """
+    UPDATE timeline_entries AS te
+    SET timestamp = m.timestamp
+    FROM messages AS m
+    WHERE te.message_id = m.id AND te.timestamp <> m.timestamp
+"""
+
+SYNC_THREADS = """
+    UPDATE threads AS t
+    SET last_activity_at = d.timestamp
+    FROM dms AS d
+    WHERE t.last_dm_id = d.id AND t.last_activity_at <> d.timestamp
+"""
+
+
+def set_timestamp_default(server_default):
+    for table in ['messages', 'dms']:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('timestamp',
+                                  existing_type=sa.DateTime(),
+                                  existing_nullable=False,
+                                  server_default=server_default)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    set_timestamp_default(
+        sa.text(UTCNOW.get(dialect, 'CURRENT_TIMESTAMP')))
+
+    if dialect == 'postgresql':
+        op.execute(SPREAD_TIES.format(table='messages'))
+        op.execute(SPREAD_TIES.format(table='dms'))
+        op.execute(SYNC_TIMELINE_ENTRIES)
+        op.execute(SYNC_THREADS)
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_timestamp_id', 'messages',
+                        ['user_id', sa.text('timestamp DESC'),
+                         sa.text('id DESC')],
+                        unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_messages_user_id_timestamp',
+                      table_name='messages', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_timestamp', 'messages',
+                        ['user_id', 'timestamp'],
+                        unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_messages_user_id_timestamp_id',
+                      table_name='messages', postgresql_concurrently=True)
+
+    set_timestamp_default(None)
@@ -0,0 +1,89 @@
+"""baseline schema
+
+The tables exactly as db.create_all() made them before migrations (no
+counters, thread activity, timelines or reaction totals; those come in
+e3a1c7b52d90). A database created that way is already at this revision:
+
+    flask db stamp 4fd4d53043f3
+    flask db upgrade
+
+Revision ID: 4fd4d53043f3
+Revises:
+Create Date: 2026-10-18 02:06:55.822511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4fd4d53043f3'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.Text(), nullable=False),
+    sa.Column('username', sa.Text(), nullable=False),
+    sa.Column('image_url', sa.Text(), nullable=True),
+    sa.Column('header_image_url', sa.Text(), nullable=True),
+    sa.Column('bio', sa.Text(), nullable=True),
+    sa.Column('location', sa.Text(), nullable=True),
+    sa.Column('password', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email'),
+    sa.UniqueConstraint('username')
+    )
+    op.create_table('follows',
+    sa.Column('followee_id', sa.Integer(), nullable=False),
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followee_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['follower_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('followee_id', 'follower_id')
+    )
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('threads',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user1_id', sa.Integer(), nullable=True),
+    sa.Column('user2_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user1_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user2_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('dms',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('thread_id', sa.Integer(), nullable=False),
+    sa.Column('author', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['author'], ['users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['thread_id'], ['threads.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('reactions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('reaction_type', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id', 'reaction_type')
+    )
+
+
+def downgrade():
+    op.drop_table('reactions')
+    op.drop_table('dms')
+    op.drop_table('threads')
+    op.drop_table('messages')
+    op.drop_table('follows')
+    op.drop_table('users')
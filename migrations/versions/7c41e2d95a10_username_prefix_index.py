@@ -0,0 +1,39 @@
+"""username prefix index
+
+An index on lower(username) for user search's short terms (under three
+characters), which only match as a prefix and so can't use the trigram
+index. Postgres only, built CONCURRENTLY.
+
+Revision ID: 7c41e2d95a10
+Revises: 29b100121e27
+Create Date: 2026-10-18 09:41:27.305118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c41e2d95a10'
+down_revision = '29b100121e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                   'ix_users_username_lower_prefix '
+                   'ON users (lower(username) text_pattern_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                   'ix_users_username_lower_prefix')
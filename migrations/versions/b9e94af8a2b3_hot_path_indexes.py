@@ -0,0 +1,59 @@
+"""hot path indexes
+
+Indexes for the queries behind the timeline, profile, follow, reaction
+and DM pages, and the trigram index for user search (which used to be
+applied by hand from sql/username_search_index.sql).
+
+On Postgres they're built CONCURRENTLY, so a live database keeps taking
+writes while this runs.
+
+Revision ID: b9e94af8a2b3
+Revises: e3a1c7b52d90
+Create Date: 2026-10-18 02:07:18.613176
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9e94af8a2b3'
+down_revision = 'e3a1c7b52d90'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp']),
+    ('ix_follows_follower_id', 'follows', ['follower_id']),
+    ('ix_reactions_user_id_reaction_type', 'reactions',
+     ['user_id', 'reaction_type']),
+    ('ix_reactions_message_id', 'reactions', ['message_id']),
+    ('ix_threads_user2_id', 'threads', ['user2_id']),
+    ('ix_dms_author', 'dms', ['author']),
+    ('ix_timeline_entries_message_id', 'timeline_entries', ['message_id']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                       'ix_users_username_trgm '
+                       'ON users USING gin (username gin_trgm_ops)')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                       'ix_users_username_trgm')
+
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
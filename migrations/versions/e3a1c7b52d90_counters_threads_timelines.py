@@ -0,0 +1,178 @@
+"""counters, thread activity, timelines and reaction totals
+
+The schema the app's stored state needs on top of the baseline:
+
+- users' messages/following/followers/reactions counters
+- threads' latest DM and activity time, and one thread per pair of users
+  (uq_threads_user1_id_user2_id, stored with user1_id < user2_id)
+- the timelines and timeline_entries tables behind the home feed
+- message_reaction_counts, the per-message reaction totals
+- the (thread_id, timestamp, id) index the thread pages read DMs by
+
+Existing threads are put in user1_id < user2_id order and duplicates for
+a pair are merged into its oldest thread (their DMs moved over) before
+the unique constraint goes on. The counters, latest DMs and reaction
+totals are then backfilled here, so nothing needs running afterwards.
+Timelines start empty and are built on each user's next visit to the
+homepage (or all at once with `flask rebuild-timelines`).
+
+Revision ID: e3a1c7b52d90
+Revises: 4fd4d53043f3
+Create Date: 2026-10-18 11:20:04.517093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1c7b52d90'
+down_revision = '4fd4d53043f3'
+branch_labels = None
+depends_on = None
+
+
+COUNTERS = ['messages_count', 'following_count', 'followers_count',
+            'reactions_count']
+
+BACKFILL_COUNTERS = """
+    UPDATE users SET
+        messages_count = (SELECT COUNT(*) FROM messages
+                          WHERE messages.user_id = users.id),
+        following_count = (SELECT COUNT(*) FROM follows
+                           WHERE follows.followee_id = users.id),
+        followers_count = (SELECT COUNT(*) FROM follows
+                           WHERE follows.follower_id = users.id),
+        reactions_count = (SELECT COUNT(*) FROM reactions
+                           WHERE reactions.user_id = users.id)
+"""
+
+# both sides of SET see the row's old values, so this swaps them
+ORDER_THREAD_USERS = """
+    UPDATE threads SET user1_id = user2_id, user2_id = user1_id
+    WHERE user1_id > user2_id
+"""
+
+MOVE_DUPLICATE_THREADS_DMS = """
+    UPDATE dms SET thread_id = (
+        SELECT MIN(keep.id)
+        FROM threads AS keep, threads AS t
+        WHERE t.id = dms.thread_id
+          AND keep.user1_id = t.user1_id AND keep.user2_id = t.user2_id)
+    WHERE thread_id IN (
+        SELECT t.id
+        FROM threads AS t, threads AS keep
+        WHERE keep.user1_id = t.user1_id AND keep.user2_id = t.user2_id
+          AND keep.id < t.id)
+"""
+
+DELETE_DUPLICATE_THREADS = """
+    DELETE FROM threads
+    WHERE id > (SELECT MIN(keep.id) FROM threads AS keep
+                WHERE keep.user1_id = threads.user1_id
+                  AND keep.user2_id = threads.user2_id)
+"""
+
+BACKFILL_LAST_DM = """
+    UPDATE threads SET last_dm_id = (
+        SELECT dms.id FROM dms
+        WHERE dms.thread_id = threads.id
+        ORDER BY dms.timestamp DESC, dms.id DESC
+        LIMIT 1)
+"""
+
+BACKFILL_LAST_ACTIVITY = """
+    UPDATE threads SET last_activity_at = (
+        SELECT dms.timestamp FROM dms WHERE dms.id = threads.last_dm_id)
+    WHERE last_dm_id IS NOT NULL
+"""
+
+BACKFILL_REACTION_COUNTS = """
+    INSERT INTO message_reaction_counts (message_id, reaction_type, count)
+    SELECT message_id, reaction_type, COUNT(*)
+    FROM reactions
+    GROUP BY message_id, reaction_type
+"""
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    for counter in COUNTERS:
+        op.add_column('users', sa.Column(counter, sa.Integer(),
+                                         server_default='0', nullable=False))
+    op.execute(BACKFILL_COUNTERS)
+
+    op.execute(ORDER_THREAD_USERS)
+    op.execute(MOVE_DUPLICATE_THREADS_DMS)
+    op.execute(DELETE_DUPLICATE_THREADS)
+
+    op.add_column('threads', sa.Column('last_dm_id', sa.Integer(),
+                                       nullable=True))
+    op.add_column('threads', sa.Column('last_activity_at', sa.DateTime(),
+                                       nullable=True))
+    with op.batch_alter_table('threads') as batch_op:
+        batch_op.create_unique_constraint('uq_threads_user1_id_user2_id',
+                                          ['user1_id', 'user2_id'])
+    # SQLite can't add a foreign key to an existing table (and the baseline
+    # never declared this one there either)
+    if dialect != 'sqlite':
+        op.create_foreign_key('fk_threads_last_dm_id', 'threads', 'dms',
+                              ['last_dm_id'], ['id'], ondelete='SET NULL')
+    op.execute(BACKFILL_LAST_DM)
+    op.execute(BACKFILL_LAST_ACTIVITY)
+
+    op.create_index('ix_dms_thread_id_timestamp_id', 'dms',
+                    ['thread_id', 'timestamp', 'id'], unique=False)
+
+    op.create_table('message_reaction_counts',
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('reaction_type', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('message_id', 'reaction_type')
+    )
+    op.execute(BACKFILL_REACTION_COUNTS)
+
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('built_at', sa.DateTime(), nullable=False),
+    sa.Column('complete', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_table('timeline_entries',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.create_index('ix_timeline_entries_user_id_timestamp',
+                    'timeline_entries', ['user_id', 'timestamp'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_entries_user_id_timestamp',
+                  table_name='timeline_entries')
+    op.drop_table('timeline_entries')
+    op.drop_table('timelines')
+    op.drop_table('message_reaction_counts')
+    op.drop_index('ix_dms_thread_id_timestamp_id', table_name='dms')
+
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_threads_last_dm_id', 'threads',
+                           type_='foreignkey')
+    with op.batch_alter_table('threads') as batch_op:
+        batch_op.drop_constraint('uq_threads_user1_id_user2_id',
+                                 type_='unique')
+        batch_op.drop_column('last_activity_at')
+        batch_op.drop_column('last_dm_id')
+
+    with op.batch_alter_table('users') as batch_op:
+        for counter in reversed(COUNTERS):
+            batch_op.drop_column(counter)
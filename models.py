@@ -4,10 +4,90 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from passwords import PasswordHasher
 
 bcrypt = Bcrypt()
+hasher = PasswordHasher(bcrypt)
 db = SQLAlchemy()
 
+# How many message ids we keep precomputed in each user's home timeline
+TIMELINE_LENGTH = 800
+
+# How far past TIMELINE_LENGTH a timeline may grow from new posts before
+# `flask trim-timelines` cuts it back. Posting never trims: that would
+# rank every recipient's timeline inside the posting request.
+TIMELINE_SLACK = 200
+
+
+class utcnow(FunctionElement):
+    """The database's current UTC time, as a naive timestamp.
+
+    For server-side defaults, so rows are stamped when they're inserted
+    rather than by whatever clock (or stale value) the app has.
+    """
+
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow, 'sqlite')
+def _utcnow_sqlite(element, compiler, **kw):
+    # CURRENT_TIMESTAMP only has whole seconds here
+    return "(STRFTIME('%Y-%m-%d %H:%M:%f', 'now'))"
+
+
+class KeysetPaged:
+    """Newest-first keyset paging for models with `timestamp` and `id`.
+
+    Pages are ordered on (timestamp, id), so rows sharing a timestamp still
+    page deterministically, and a page seeks with a row comparison against
+    the previous page's `cursor` instead of using an OFFSET.
+    """
+
+    @property
+    def cursor(self):
+        """Keyset cursor pointing just past this row (see `page`)."""
+
+        return f"{self.timestamp.isoformat()}_{self.id}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Turn a `cursor` string back into a (timestamp, id) tuple.
+
+        Raises ValueError if it's not a cursor we handed out.
+        """
+
+        timestamp, row_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+
+    @classmethod
+    def page(cls, query, before=None, limit=100):
+        """Newest-first page of `query`, older than the `before` cursor."""
+
+        if before:
+            query = query.filter(db.tuple_(cls.timestamp, cls.id) < before)
+
+        return (query
+                .order_by(None)
+                .order_by(cls.timestamp.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
 
 class FollowersFollowee(db.Model):
     """Connection of a follower <-> followee."""
@@ -26,6 +106,11 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers lookups by followee_id
+    __table_args__ = (
+        db.Index('ix_follows_follower_id', 'follower_id'),
+    )
+
 
 class Thread(db.Model):
     """Connection from one user to another for a dm """
@@ -44,12 +129,142 @@ class Thread(db.Model):
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"))
 
-    db.UniqueConstraint('user1_id', 'user2_id')
+    # a pair of users has one thread, stored with user1_id < user2_id
+    __table_args__ = (
+        db.UniqueConstraint('user1_id', 'user2_id',
+                            name='uq_threads_user1_id_user2_id'),
+        # for the inbox, which finds threads by either member
+        db.Index('ix_threads_user2_id', 'user2_id'),
+    )
+
+    # the newest DM, kept up to date by `record_dm` so the inbox doesn't
+    # have to load every DM to show a preview
+    last_dm_id = db.Column(
+        db.Integer,
+        db.ForeignKey('dms.id', ondelete="SET NULL",
+                      use_alter=True, name='fk_threads_last_dm_id'))
+
+    last_activity_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+    )
 
     user1 = db.relationship("User", foreign_keys=[user1_id])
     user2 = db.relationship("User", foreign_keys=[user2_id])
 
-    dms = db.relationship("DM", backref="thread")
+    dms = db.relationship("DM", backref="thread", foreign_keys="DM.thread_id",
+                          lazy='dynamic', order_by=lambda: [DM.timestamp, DM.id])
+
+    @classmethod
+    def get_or_create_id(cls, user_id, other_id):
+        """Id of the thread between these two users, creating it if needed.
+
+        Safe against concurrent calls for the same pair: the unique
+        constraint decides, and a losing insert finds the winner's row.
+        """
+
+        user1_id, user2_id = sorted([user_id, other_id])
+
+        def find():
+            return (db.session
+                    .query(cls.id)
+                    .filter(cls.user1_id == user1_id,
+                            cls.user2_id == user2_id)
+                    .scalar())
+
+        thread_id = find()
+        if thread_id:
+            return thread_id
+
+        if db.engine.dialect.name == 'postgresql':
+            thread_id = db.session.execute(
+                pg_insert(cls.__table__)
+                .values(user1_id=user1_id, user2_id=user2_id)
+                .on_conflict_do_nothing(index_elements=['user1_id',
+                                                        'user2_id'])
+                .returning(cls.id)).scalar()
+
+        else:
+            try:
+                with db.session.begin_nested():
+                    thread_id = db.session.execute(
+                        cls.__table__.insert().values(
+                            user1_id=user1_id,
+                            user2_id=user2_id)).inserted_primary_key[0]
+            except IntegrityError:
+                pass
+
+        # None if another request created it first
+        return thread_id or find()
+
+    def has_member(self, user_id):
+        """Is `user_id` one of the two users in this thread?"""
+
+        return user_id in (self.user1_id, self.user2_id)
+
+    @classmethod
+    def inbox(cls, user_id):
+        """Threads `user_id` is in, most recently active first, in one query.
+
+        Each row has thread_id, the other user's user_id/username/image_url,
+        and last_dm_text (None if nothing's been said yet).
+        """
+
+        other_id = db.case([(cls.user1_id == user_id, cls.user2_id)],
+                           else_=cls.user1_id)
+
+        return (db.session
+                .query(cls.id.label('thread_id'),
+                       User.id.label('user_id'),
+                       User.username,
+                       User.image_url,
+                       DM.text.label('last_dm_text'))
+                .join(User, User.id == other_id)
+                .outerjoin(DM, DM.id == cls.last_dm_id)
+                .filter(db.or_(cls.user1_id == user_id,
+                               cls.user2_id == user_id))
+                .order_by(cls.last_activity_at.desc().nullslast(),
+                          cls.id.desc())
+                .all())
+
+    @classmethod
+    def record_dm(cls, dm):
+        """Make a new (flushed) `dm` its thread's latest, unless a later
+        one has been recorded already (by a request that committed first)."""
+
+        (cls
+         .query
+         .filter(cls.id == dm.thread_id,
+                 db.or_(cls.last_dm_id.is_(None), cls.last_dm_id < dm.id))
+         .update({cls.last_dm_id: dm.id,
+                  cls.last_activity_at: dm.timestamp},
+                 synchronize_session=False))
+
+    @classmethod
+    def backfill_last_dm(cls):
+        """Recompute every thread's latest DM from the dms table."""
+
+        latest = (db.session
+                  .query(DM.id)
+                  .filter(DM.thread_id == cls.id)
+                  .order_by(DM.timestamp.desc(), DM.id.desc())
+                  .limit(1)
+                  .correlate(cls)
+                  .as_scalar())
+
+        (cls
+         .query
+         .update({cls.last_dm_id: latest}, synchronize_session=False))
+
+        (cls
+         .query
+         .filter(cls.last_dm_id.isnot(None))
+         .update({cls.last_activity_at: (db.session
+                                         .query(DM.timestamp)
+                                         .filter(DM.id == cls.last_dm_id)
+                                         .correlate(cls)
+                                         .as_scalar())},
+                 synchronize_session=False))
 
 
 class User(db.Model):
@@ -97,9 +312,44 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref='user', lazy='dynamic')
+    # Denormalized counts, kept up to date by the routes that change them
+    # (see `adjust_counters`) and recomputed by `repair_counters`
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    reactions_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # left to the database's ON DELETE CASCADE, like Message.reaction
+    messages = db.relationship('Message', backref='user', lazy='dynamic',
+                               cascade='all, delete-orphan',
+                               passive_deletes=True)
+    # read-only: reactions are added and removed through Reaction
     reacted_messages = db.relationship(
-        'Message', secondary="reactions", backref="users_who_reacted")
+        'Message', secondary="reactions", viewonly=True)
     reactions = db.relationship(
         'Reaction', backref='user', cascade="all,delete-orphan")
 
@@ -132,6 +382,58 @@ class User(db.Model):
 
         return bool(self.following.filter_by(id=other_user.id).first())
 
+    def get_following_ids(self, user_ids):
+        """Which of `user_ids` this user follows, as a set, in one query."""
+
+        if not user_ids:
+            return set()
+
+        # as with the `following` relationship, a follows row's followee_id
+        # is the user doing the following
+        return {follower_id for follower_id, in db.session
+                .query(FollowersFollowee.follower_id)
+                .filter(FollowersFollowee.followee_id == self.id,
+                        FollowersFollowee.follower_id.in_(user_ids))}
+
+    @classmethod
+    def search(cls, term, limit):
+        """Users whose username contains `term`, best matches first.
+
+        Exact matches come first, then prefix matches, then the rest. On
+        Postgres this is served by the trigram index on username (see
+        USERNAME_TRGM_INDEX below). Terms too short to make trigrams, which
+        that index can't serve, only match as a prefix of lower(username):
+        a range scan of USERNAME_PREFIX_INDEX instead, though one as short
+        as "us" still reads every username it prefixes before ranking.
+        """
+
+        escaped = (term.replace('\\', '\\\\')
+                       .replace('%', '\\%')
+                       .replace('_', '\\_'))
+
+        if len(term) < 3:
+            match = db.func.lower(cls.username).like(
+                f"{escaped.lower()}%", escape='\\')
+        else:
+            match = cls.username.ilike(f"%{escaped}%", escape='\\')
+
+        rank = db.case(
+            [(db.func.lower(cls.username) == term.lower(), 0),
+             (cls.username.ilike(f"{escaped}%", escape='\\'), 1)],
+            else_=2)
+        order_by = [rank]
+
+        # SQLite (tests) has no pg_trgm: plain LIKE matching and ranking
+        if db.engine.dialect.name == 'postgresql':
+            order_by.append(db.func.similarity(cls.username, term).desc())
+
+        return (cls
+                .query
+                .filter(match)
+                .order_by(*order_by, cls.username)
+                .limit(limit)
+                .all())
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -139,7 +441,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -159,18 +461,59 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
+        If the hash was made at a different cost than BCRYPT_LOG_ROUNDS, it's
+        re-hashed at the current cost (commit to save it).
+
         If can't find matching user (or if password is wrong), returns False.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check_password_hash(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.generate_password_hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counters(cls, user_id, **deltas):
+        """Add `deltas` to the stored counters of `user_id`.
+
+        For example: User.adjust_counters(1, messages_count=1)
+
+        Done as `SET n = n + delta` in the current transaction, so concurrent
+        requests don't overwrite each other's counts.
+        """
+
+        (cls
+         .query
+         .filter(cls.id == user_id)
+         .update({getattr(cls, counter): getattr(cls, counter) + delta
+                  for counter, delta in deltas.items()},
+                 synchronize_session=False))
+
+    @classmethod
+    def repair_counters(cls):
+        """Recompute every user's stored counters from scratch."""
+
+        def count(column, *criteria):
+            return (db.session
+                    .query(db.func.count())
+                    .filter(column == cls.id, *criteria)
+                    .correlate(cls)
+                    .as_scalar())
+
+        (cls
+         .query
+         .update({cls.messages_count: count(Message.user_id),
+                  cls.following_count: count(FollowersFollowee.followee_id),
+                  cls.followers_count: count(FollowersFollowee.follower_id),
+                  cls.reactions_count: count(Reaction.user_id)},
+                 synchronize_session=False))
+
     def get_reactions(self, reaction_type):
         return {message_id[0] for message_id in db.session.query(Reaction.message_id).filter(
             Reaction.reaction_type == reaction_type, Reaction.user_id == self.id).all()}
@@ -178,8 +521,36 @@ class User(db.Model):
     def get_my_messages(self):
         return {message_id[0] for message_id in db.session.query(Message.id).filter(Message.user_id == self.id).all()}
 
+    def get_reaction_state(self, message_ids):
+        """This user's reactions to, and authorship of, `message_ids`.
+
+        Returns ({reaction_type: {message_id, ...}}, {my message_id, ...}),
+        looked up in a single query over just these messages.
+        """
+
+        reactions = {}
+        my_msgs = set()
+
+        if not message_ids:
+            return reactions, my_msgs
+
+        rows = (db.session
+                .query(Message.id, Message.user_id, Reaction.reaction_type)
+                .outerjoin(Reaction, db.and_(Reaction.message_id == Message.id,
+                                             Reaction.user_id == self.id))
+                .filter(Message.id.in_(message_ids))
+                .all())
+
+        for message_id, author_id, reaction_type in rows:
+            if author_id == self.id:
+                my_msgs.add(message_id)
+            if reaction_type:
+                reactions.setdefault(reaction_type, set()).add(message_id)
+
+        return reactions, my_msgs
 
-class Message(db.Model):
+
+class Message(KeysetPaged, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
@@ -197,7 +568,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -205,7 +576,46 @@ class Message(db.Model):
         db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
     )
-    reaction = db.relationship('Reaction', backref='message')
+    # left to the database's ON DELETE CASCADE, rather than loaded to be
+    # deleted one by one
+    reaction = db.relationship('Reaction', backref='message',
+                               cascade='all, delete-orphan',
+                               passive_deletes=True)
+    users_who_reacted = db.relationship(
+        'User', secondary="reactions", viewonly=True)
+
+    # read back the server-side timestamp on insert
+    __mapper_args__ = {'eager_defaults': True}
+
+    @classmethod
+    def feed(cls, user_id):
+        """Query for the messages of `user_id` and everyone they follow."""
+
+        following_ids = (db.session
+                         .query(FollowersFollowee.follower_id)
+                         .filter(FollowersFollowee.followee_id == user_id))
+
+        return cls.query.filter(db.or_(cls.user_id == user_id,
+                                       cls.user_id.in_(following_ids)))
+
+    @classmethod
+    def reacted_to_by(cls, user_id):
+        """Query for the messages `user_id` has reacted to, newest first."""
+
+        reacted_ids = (db.session
+                       .query(Reaction.message_id)
+                       .filter(Reaction.user_id == user_id))
+
+        return (cls
+                .query
+                .filter(cls.id.in_(reacted_ids))
+                .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+
+# each user's messages newest first, in the order the feed, timeline
+# rebuilds and profile pages read them
+db.Index('ix_messages_user_id_timestamp_id',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
 
 
 class Reaction(db.Model):
@@ -223,8 +633,193 @@ class Reaction(db.Model):
     reaction_type = db.Column(
         db.String, nullable=False, primary_key=True)
 
+    __table_args__ = (
+        db.Index('ix_reactions_user_id_reaction_type',
+                 'user_id', 'reaction_type'),
+        db.Index('ix_reactions_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id, reaction_type):
+        """Make sure `user_id` has this reaction on `message_id`.
+
+        Safe to repeat: only a reaction that wasn't there already is
+        counted. Returns whether one was added.
+        """
+
+        values = dict(user_id=user_id, message_id=message_id,
+                      reaction_type=reaction_type)
+
+        if db.engine.dialect.name == 'postgresql':
+            added = db.session.execute(
+                pg_insert(cls.__table__)
+                .values(**values)
+                .on_conflict_do_nothing()).rowcount == 1
+
+        else:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(cls.__table__.insert().values(**values))
+                added = True
+            except IntegrityError:
+                added = False
+
+        if added:
+            User.adjust_counters(user_id, reactions_count=1)
+            MessageReactionCount.adjust(message_id, reaction_type, 1)
+
+        return added
+
+    @classmethod
+    def remove(cls, user_id, message_id, reaction_type):
+        """Make sure `user_id` doesn't have this reaction on `message_id`.
+
+        Safe to repeat, like add(). Returns whether one was removed.
+        """
+
+        removed = (cls
+                   .query
+                   .filter(cls.user_id == user_id,
+                           cls.message_id == message_id,
+                           cls.reaction_type == reaction_type)
+                   .delete(synchronize_session=False)) == 1
+
+        if removed:
+            User.adjust_counters(user_id, reactions_count=-1)
+            MessageReactionCount.adjust(message_id, reaction_type, -1)
+
+        return removed
 
-class DM(db.Model):
+
+class MessageReactionCount(db.Model):
+    """How many reactions of each type a message has.
+
+    Kept in step with `reactions` by the views, so totals for a page of
+    messages are a primary key lookup instead of a count over reactions.
+    """
+
+    __tablename__ = 'message_reaction_counts'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True)
+    reaction_type = db.Column(
+        db.String, primary_key=True)
+    count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    @classmethod
+    def adjust(cls, message_id, reaction_type, delta):
+        """Add `delta` to the count of `reaction_type` on `message_id`.
+
+        Done as `SET count = count + delta` in the current transaction
+        (an upsert for the first reaction of a type), so concurrent
+        reactions don't overwrite each other's counts.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            insert = pg_insert(cls.__table__).values(
+                message_id=message_id, reaction_type=reaction_type,
+                count=delta)
+            db.session.execute(insert.on_conflict_do_update(
+                index_elements=['message_id', 'reaction_type'],
+                set_={'count': cls.__table__.c.count + insert.excluded.count}))
+            return
+
+        def update():
+            return (cls
+                    .query
+                    .filter(cls.message_id == message_id,
+                            cls.reaction_type == reaction_type)
+                    .update({cls.count: cls.count + delta},
+                            synchronize_session=False))
+
+        if update():
+            return
+
+        try:
+            with db.session.begin_nested():
+                db.session.execute(cls.__table__.insert().values(
+                    message_id=message_id, reaction_type=reaction_type,
+                    count=delta))
+        except IntegrityError:
+            # another request inserted it first
+            update()
+
+    @classmethod
+    def remove_user(cls, user_id):
+        """Take the reactions of `user_id` off the counts, before the user
+        (and with it their reactions) is deleted."""
+
+        (cls
+         .query
+         .filter(db.tuple_(cls.message_id, cls.reaction_type).in_(
+             db.session
+             .query(Reaction.message_id, Reaction.reaction_type)
+             .filter(Reaction.user_id == user_id)))
+         .update({cls.count: cls.count - 1},
+                 synchronize_session=False))
+
+    @classmethod
+    def totals_for(cls, message_ids):
+        """Reaction totals for `message_ids`, in one indexed lookup.
+
+        Returns {reaction_type: {message_id: count}}, leaving out zeros.
+        """
+
+        totals = {}
+
+        if not message_ids:
+            return totals
+
+        rows = (db.session
+                .query(cls.message_id, cls.reaction_type, cls.count)
+                .filter(cls.message_id.in_(message_ids), cls.count > 0))
+
+        for message_id, reaction_type, count in rows:
+            totals.setdefault(reaction_type, {})[message_id] = count
+
+        return totals
+
+    @classmethod
+    def reconcile(cls):
+        """Recompute every count from `reactions`, fixing any drift.
+
+        Returns how many counts were wrong.
+        """
+
+        actual = (db.session
+                  .query(Reaction.message_id.label('message_id'),
+                         Reaction.reaction_type.label('reaction_type'),
+                         db.func.count().label('count'))
+                  .group_by(Reaction.message_id, Reaction.reaction_type)
+                  .subquery())
+
+        missing_or_off = (db.session
+                          .query(actual)
+                          .filter(~db.exists().where(db.and_(
+                              cls.message_id == actual.c.message_id,
+                              cls.reaction_type == actual.c.reaction_type,
+                              cls.count == actual.c.count)))
+                          .count())
+        stale = (cls
+                 .query
+                 .filter(cls.count != 0,
+                         ~db.exists().where(db.and_(
+                             Reaction.message_id == cls.message_id,
+                             Reaction.reaction_type == cls.reaction_type)))
+                 .count())
+
+        cls.query.delete(synchronize_session=False)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['message_id', 'reaction_type', 'count'],
+            db.session.query(actual)))
+
+        return missing_or_off + stale
+
+
+class DM(KeysetPaged, db.Model):
     """the exact message, connected to a thread"""
     __tablename__ = 'dms'
 
@@ -241,7 +836,7 @@ class DM(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     thread_id = db.Column(
@@ -257,6 +852,436 @@ class DM(db.Model):
     )
     user = db.relationship("User", backref="dm")
 
+    __table_args__ = (
+        db.Index('ix_dms_thread_id_timestamp_id',
+                 'thread_id', 'timestamp', 'id'),
+        db.Index('ix_dms_author', 'author'),
+    )
+
+    __mapper_args__ = {'eager_defaults': True}
+
+    def serialize(self):
+        """This DM as a dict, for JSON responses."""
+
+        return {
+            'id': self.id,
+            'text': self.text,
+            'author': self.author,
+            'timestamp': self.timestamp.isoformat(),
+        }
+
+
+class Timeline(db.Model):
+    """Marks a user's precomputed home timeline as built.
+
+    A user without a row here has never had their timeline built (or it
+    was thrown away), so their feed has to come from the slow query.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    built_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # False once entries have been trimmed off the end: older messages
+    # then exist that the timeline can't serve
+    complete = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    @classmethod
+    def messages_for(cls, user_id, limit, before=None):
+        """Newest `limit` messages from `user_id`'s timeline, older than the
+        `before` cursor, as MessageRows.
+
+        Returns None when the timeline can't answer: it isn't built, or it
+        runs out before filling the page and has been trimmed.
+        """
+
+        query = MessageRow.project(
+            db.session
+            .query(Message)
+            .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+            .join(cls, cls.user_id == TimelineEntry.user_id)
+            .filter(TimelineEntry.user_id == user_id),
+            cls.complete)
+
+        if before:
+            query = query.filter(
+                db.tuple_(TimelineEntry.timestamp,
+                          TimelineEntry.message_id) < before)
+
+        results = (query
+                   .order_by(TimelineEntry.timestamp.desc(),
+                             TimelineEntry.message_id.desc())
+                   .limit(limit)
+                   .all())
+
+        if len(results) < limit:
+            # a short page: only then do we need to know whether the
+            # timeline has everything, which costs a lookup if it's empty
+            if results:
+                complete = results[0].complete
+            else:
+                timeline = cls.query.get(user_id)
+                complete = timeline and timeline.complete
+
+            if not complete:
+                return None
+
+        return [MessageRow.from_row(row) for row in results]
+
+    @classmethod
+    def fan_out(cls, message):
+        """Push a new (flushed) message onto its author's and followers'
+        timelines, one row each. They aren't trimmed here (see
+        TIMELINE_SLACK)."""
+
+        # only timelines that are already built; the rest get rebuilt on read
+        recipients = (db.session
+                      .query(FollowersFollowee.followee_id.label('user_id'))
+                      .join(cls, cls.user_id == FollowersFollowee.followee_id)
+                      .filter(FollowersFollowee.follower_id == message.user_id)
+                      .union(db.session
+                             .query(cls.user_id.label('user_id'))
+                             .filter(cls.user_id == message.user_id))
+                      .subquery())
+
+        rows = (db.session
+                .query(recipients.c.user_id,
+                       Message.id,
+                       Message.user_id,
+                       Message.timestamp)
+                .filter(Message.id == message.id))
+
+        db.session.execute(
+            TimelineEntry.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                rows))
+
+    @classmethod
+    def add_author(cls, user_id, author_id):
+        """Merge `author_id`'s newest messages into `user_id`'s timeline
+        (after a follow)."""
+
+        # your own messages are always on your timeline
+        if author_id == user_id or not cls.query.get(user_id):
+            return
+
+        already_there = (db.session
+                         .query(TimelineEntry.message_id)
+                         .filter(TimelineEntry.user_id == user_id,
+                                 TimelineEntry.message_id == Message.id)
+                         .exists())
+
+        unmerged = (db.session
+                    .query(db.literal(user_id),
+                           Message.id,
+                           Message.user_id,
+                           Message.timestamp)
+                    .filter(Message.user_id == author_id, ~already_there)
+                    .order_by(Message.timestamp.desc(), Message.id.desc()))
+
+        # more than fit: the ones left out are missing from the timeline,
+        # so it can no longer say where the feed ends
+        capped = (db.session
+                  .query(unmerged.offset(TIMELINE_LENGTH).limit(1).exists())
+                  .scalar())
+
+        db.session.execute(
+            TimelineEntry.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                unmerged.limit(TIMELINE_LENGTH)))
+
+        if capped:
+            (cls
+             .query
+             .filter(cls.user_id == user_id)
+             .update({cls.complete: False}, synchronize_session=False))
+
+        TimelineEntry.trim([user_id])
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop `author_id`'s messages from `user_id`'s timeline (after an
+        unfollow)."""
+
+        if author_id == user_id:
+            return
+
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id,
+                 TimelineEntry.author_id == author_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Drop a message from every timeline it was pushed to."""
+
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.message_id == message_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """Recompute `user_id`'s timeline from the follows/messages tables.
+
+        Safe to run twice at once for the same user (two first visits to
+        the homepage, say): on Postgres the loser skips the entries the
+        winner already wrote, and the timelines row is upserted.
+        """
+
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id)
+         .delete(synchronize_session=False))
+
+        rows = (Message
+                .feed(user_id)
+                .with_entities(db.literal(user_id),
+                               Message.id,
+                               Message.user_id,
+                               Message.timestamp)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(TIMELINE_LENGTH))
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(
+                pg_insert(TimelineEntry.__table__)
+                .from_select(columns, rows)
+                .on_conflict_do_nothing())
+        else:
+            db.session.execute(
+                TimelineEntry.__table__.insert().from_select(columns, rows))
+
+        # counted rather than taken from the insert's rowcount, which
+        # leaves out entries a concurrent rebuild got in first
+        complete = (TimelineEntry
+                    .query
+                    .filter(TimelineEntry.user_id == user_id)
+                    .count()) < TIMELINE_LENGTH
+        values = dict(built_at=datetime.utcnow(), complete=complete)
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(
+                pg_insert(cls.__table__)
+                .values(user_id=user_id, **values)
+                .on_conflict_do_update(index_elements=['user_id'],
+                                       set_=values))
+        else:
+            db.session.merge(cls(user_id=user_id, **values))
+
+
+class TimelineEntry(db.Model):
+    """A message precomputed into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # copy of the message's timestamp, so ordering never touches messages
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp'),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def trim(cls, user_ids, slack=0):
+        """Cut each of these users' timelines that has more than
+        TIMELINE_LENGTH + `slack` entries back to TIMELINE_LENGTH, newest
+        first by (timestamp, message_id), as the feed pages them.
+
+        Returns how many timelines were cut.
+        """
+
+        newer = db.aliased(cls)
+
+        # one short probe per timeline, for an entry past the cap
+        overflowing = (db.session
+                       .query(newer.user_id)
+                       .filter(newer.user_id == Timeline.user_id)
+                       .offset(TIMELINE_LENGTH + slack)
+                       .limit(1)
+                       .correlate(Timeline)
+                       .exists())
+
+        full_ids = [user_id for user_id, in db.session
+                    .query(Timeline.user_id)
+                    .filter(Timeline.user_id.in_(user_ids), overflowing)]
+
+        if not full_ids:
+            return 0
+
+        (Timeline
+         .query
+         .filter(Timeline.user_id.in_(full_ids))
+         .update({Timeline.complete: False}, synchronize_session=False))
+
+        # rank each of those timelines once, rather than working out a
+        # cutoff again for every entry
+        ranked = (db.session
+                  .query(cls.user_id,
+                         cls.message_id,
+                         db.func.row_number().over(
+                             partition_by=cls.user_id,
+                             order_by=[cls.timestamp.desc(),
+                                       cls.message_id.desc()]).label('n'))
+                  .filter(cls.user_id.in_(full_ids))
+                  .subquery())
+
+        excess = (db.session
+                  .query(ranked.c.user_id, ranked.c.message_id)
+                  .filter(ranked.c.n > TIMELINE_LENGTH))
+
+        (cls
+         .query
+         .filter(db.tuple_(cls.user_id, cls.message_id).in_(excess))
+         .delete(synchronize_session=False))
+
+        return len(full_ids)
+
+
+# Trigram index so `User.search` can use an index for substring matches
+# (a leading-wildcard LIKE can't use the btree behind username's unique
+# constraint). Postgres only; migration b9e94af8a2b3 adds it to existing
+# databases.
+
+PG_TRGM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+USERNAME_TRGM_INDEX = ("CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+                       "ON users USING gin (username gin_trgm_ops)")
+
+# ...and a btree on lower(username) for `User.search`'s prefix matches of
+# short terms, which the trigram index can't serve, nor can the unique
+# constraint's btree (case-sensitive, and in the database's collation
+# rather than text_pattern_ops, so not usable for LIKE). Postgres only;
+# migration 7c41e2d95a10 adds it to existing databases.
+
+USERNAME_PREFIX_INDEX = ("CREATE INDEX IF NOT EXISTS "
+                         "ix_users_username_lower_prefix "
+                         "ON users (lower(username) text_pattern_ops)")
+
+event.listen(User.__table__, 'before_create',
+             DDL(PG_TRGM_EXTENSION).execute_if(dialect='postgresql'))
+event.listen(User.__table__, 'after_create',
+             DDL(USERNAME_TRGM_INDEX).execute_if(dialect='postgresql'))
+event.listen(User.__table__, 'after_create',
+             DDL(USERNAME_PREFIX_INDEX).execute_if(dialect='postgresql'))
+
+
+# Read models: what list pages show of each row, loaded with
+# Query.with_entities. Plain __slots__ objects, so there's no identity
+# map or change tracking to pay for, and no columns (like the password
+# hash) that the page never prints.
+
+
+class ReadModel:
+    """Base for read models: `fields` names the columns loaded, in order."""
+
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.fields, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} #{self.id}>"
+
+
+class UserCard(ReadModel):
+    """A user as a list of users shows them."""
+
+    __slots__ = fields = ('id', 'username', 'image_url', 'header_image_url',
+                          'bio')
+
+    @classmethod
+    def load(cls, query):
+        """Run `query` (of User) for just these columns."""
+
+        return [cls(*row) for row in query.with_entities(
+            *[getattr(User, name) for name in cls.fields])]
+
+
+class Author(ReadModel):
+    """The author of a message in a list of messages."""
+
+    __slots__ = fields = ('id', 'username', 'image_url')
+
+
+class MessageRow(ReadModel):
+    """A message as a list of messages shows it, with its `user`."""
+
+    __slots__ = fields = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    cursor = KeysetPaged.cursor
+
+    @classmethod
+    def project(cls, query, *extra):
+        """`query` (of Message) selecting these columns, and the author's,
+        in one go, followed by `extra` columns."""
+
+        return (query
+                .join(User, User.id == Message.user_id)
+                .with_entities(Message.id, Message.text, Message.timestamp,
+                               Message.user_id, User.username,
+                               User.image_url, *extra))
+
+    @classmethod
+    def from_row(cls, row):
+        message_id, text, timestamp, user_id, username, image_url = row[:6]
+        return cls(message_id, text, timestamp, user_id,
+                   Author(user_id, username, image_url))
+
+    @classmethod
+    def load(cls, query):
+        """Run `query` (of Message) for MessageRows."""
+
+        return [cls.from_row(row) for row in cls.project(query)]
+
+    @classmethod
+    def page(cls, query, before=None, limit=100):
+        """As Message.page, but MessageRows."""
+
+        return [cls.from_row(row)
+                for row in Message.page(cls.project(query), before, limit)]
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -266,3 +1291,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
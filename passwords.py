@@ -0,0 +1,99 @@
+"""Password hashing for Warbler, run on a small bounded pool of threads.
+
+bcrypt is deliberately slow (~250ms a hash at cost 12). Run inline, a
+burst of logins ties up every request thread and starves everything else
+(like timeline reads). So hashing and checking go through a pool of
+BCRYPT_MAX_WORKERS threads, and at most BCRYPT_MAX_PENDING requests may
+be waiting on it at once. Past that we refuse straight away, with
+HashingPoolFull, rather than queue up more work than we can do.
+
+The work factor is BCRYPT_LOG_ROUNDS. Hashes made at another cost are
+upgraded the next time their owner logs in (see `needs_rehash`), and
+every hash/check is timed into the `warbler_bcrypt_seconds` histogram so
+the cost can be tuned against login latency.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Histogram
+
+BCRYPT_SECONDS = Histogram(
+    'warbler_bcrypt_seconds',
+    "Time spent in bcrypt, by operation (hash or verify).",
+    ['operation'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+
+
+def hash_cost(pw_hash):
+    """The cost (log rounds) a bcrypt hash was made with: $2b$<cost>$..."""
+
+    return int(pw_hash.split('$')[2])
+
+
+class HashingPoolFull(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+class PasswordHasher:
+    """Bounded-concurrency front end for a Flask-Bcrypt `bcrypt`."""
+
+    def __init__(self, bcrypt):
+        self.bcrypt = bcrypt
+        self.log_rounds = 12
+        self.executor = None
+        self.slots = None
+
+    def init_app(self, app):
+        """Set the work factor and size the pool from app config."""
+
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_MAX_WORKERS', 2)
+        app.config.setdefault('BCRYPT_MAX_PENDING', 2)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['BCRYPT_MAX_WORKERS'],
+            thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(
+            app.config['BCRYPT_MAX_PENDING'])
+        self.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def generate_password_hash(self, password):
+        """Hash `password` at the configured cost, returning a str."""
+
+        return self._run('hash', self.bcrypt.generate_password_hash,
+                         password, self.log_rounds).decode('UTF-8')
+
+    def check_password_hash(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run('verify', self.bcrypt.check_password_hash,
+                         pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a cost other than the configured one?"""
+
+        return hash_cost(pw_hash) != self.log_rounds
+
+    def _run(self, operation, fn, *args):
+        """Run `fn(*args)` on the pool, timed, and wait for it.
+
+        Raises HashingPoolFull if BCRYPT_MAX_PENDING calls are already
+        running or waiting.
+        """
+
+        def timed():
+            with BCRYPT_SECONDS.labels(operation).time():
+                return fn(*args)
+
+        # not set up (scripts that never call init_app): just run it here
+        if self.executor is None:
+            return timed()
+
+        if not self.slots.acquire(blocking=False):
+            raise HashingPoolFull()
+
+        try:
+            return self.executor.submit(timed).result()
+        finally:
+            self.slots.release()
@@ -0,0 +1,162 @@
+"""Publish/subscribe fan-out for pushing events to open streams.
+
+Requests publish small JSON-able dicts to named channels (like
+"thread:12") and each open stream holds a subscription to its channel.
+
+- LocalPubSub fans out within this process only. Fine for `flask run`
+  or a single worker.
+
+- PostgresPubSub fans out across processes with LISTEN/NOTIFY. Each
+  process keeps one dedicated listening connection, blocked in select(),
+  and hands what arrives to its local subscribers. So an idle stream
+  costs a queue, not a DB connection or any polling.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One listener's queue of messages on a channel."""
+
+    def __init__(self, pubsub, channel):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """Next message, or None if nothing arrives within `timeout` secs."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Stop receiving messages."""
+
+        self.pubsub.unsubscribe(self)
+
+
+class LocalPubSub:
+    """In-process pub/sub."""
+
+    # largest JSON payload publish() accepts, in bytes (None: no limit)
+    max_payload = None
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """Start receiving messages published to `channel`."""
+
+        subscription = Subscription(self, channel)
+
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.channels.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.channels.pop(subscription.channel, None)
+
+    def publish(self, channel, data):
+        """Send `data` to everyone subscribed to `channel`."""
+
+        self.deliver(channel, data)
+
+    def deliver(self, channel, data):
+        """Hand `data` to this process's subscribers to `channel`."""
+
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+
+        for subscription in subscriptions:
+            subscription.queue.put(data)
+
+
+class PostgresPubSub(LocalPubSub):
+    """Pub/sub across every process sharing a Postgres database."""
+
+    NOTIFY_CHANNEL = 'warbler_events'
+
+    # NOTIFY payloads must be under 8000 bytes
+    max_payload = 7900
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.listener = None
+
+    def publish(self, channel, data):
+        """NOTIFY every process; their listeners deliver locally."""
+
+        payload = json.dumps({'channel': channel, 'data': data})
+
+        with self.engine.connect() as conn:
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)")
+                .execution_options(autocommit=True),
+                channel=self.NOTIFY_CHANNEL, payload=payload)
+
+    def subscribe(self, channel):
+        self.start_listener()
+        return super().subscribe(channel)
+
+    def start_listener(self):
+        """Start this process's listener thread, if it isn't running.
+
+        Started lazily, so it happens in each gunicorn worker after fork.
+        """
+
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(
+                    target=self.listen, name='pubsub-listener', daemon=True)
+                self.listener.start()
+
+    def listen(self):
+        """Deliver NOTIFYs to local subscribers, forever, reconnecting on
+        errors."""
+
+        while True:
+            try:
+                self.listen_once()
+            except Exception:
+                logger.exception("pub/sub listener failed; reconnecting")
+                time.sleep(1)
+
+    def listen_once(self):
+        # a dedicated connection, taken out of the pool for good
+        conn = self.engine.raw_connection()
+        conn.detach()
+        dbapi_conn = conn.connection
+
+        try:
+            dbapi_conn.autocommit = True
+            dbapi_conn.cursor().execute(f"LISTEN {self.NOTIFY_CHANNEL}")
+
+            while True:
+                if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                    continue
+
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    notify = dbapi_conn.notifies.pop(0)
+                    message = json.loads(notify.payload)
+                    self.deliver(message['channel'], message['data'])
+        finally:
+            conn.close()
@@ -0,0 +1,182 @@
+"""Check that the queries behind the busiest pages are served by indexes.
+
+Requests each page in HOT_PAGES through the test client, as a sample
+user from the database, and records the SELECTs it runs. Each one is
+then EXPLAINed with the same parameters. On Postgres that's done with
+enable_seqscan off: the planner still picks a sequential scan when no
+index can serve a query, so any Seq Scan left in the plan means an index
+is missing, however small the tables are. SQLite has no such switch, so
+there any full SCAN counts, except one that reads a table in id order
+for an ORDER BY id ... LIMIT and so stops after the rows it returns.
+
+Run it against a seeded database:
+
+    flask check-query-plans
+"""
+
+import re
+
+from sqlalchemy import event
+
+from models import db, User, Thread, DM
+
+# pages to check; formatted with user_id, username, thread_id and before
+# (a cursor for the thread's history)
+HOT_PAGES = [
+    # twice: the first visit may have to build the timeline
+    '/',
+    '/',
+    '/users',
+    '/users/{user_id}',
+    '/users/{user_id}/following',
+    '/users/{user_id}/followers',
+    '/users/{user_id}/reactions',
+    '/threads',
+    '/threads/{thread_id}',
+    '/threads/{thread_id}/dms?after=0',
+    '/threads/{thread_id}/history?before={before}',
+]
+
+# substring search needs the pg_trgm index, so only Postgres can do it
+# without a scan
+POSTGRES_HOT_PAGES = [
+    '/users?q={username}',
+]
+
+SQLITE_TABLE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+
+
+def sample_params():
+    """Values to fill in HOT_PAGES with: the user who follows the most
+    people, and one of their threads (thread_id is None if they have
+    none)."""
+
+    user = User.query.order_by(User.following_count.desc(), User.id).first()
+    if not user:
+        raise LookupError("No users: seed the database first.")
+
+    thread = (Thread
+              .query
+              .filter(db.or_(Thread.user1_id == user.id,
+                             Thread.user2_id == user.id))
+              .order_by(Thread.id)
+              .first())
+    newest_dm = thread and thread.dms.order_by(None).order_by(
+        DM.timestamp.desc(), DM.id.desc()).first()
+
+    return {'user_id': user.id,
+            'username': user.username[:4],
+            'thread_id': thread.id if thread else None,
+            'before': newest_dm.cursor if newest_dm else ''}
+
+
+def capture_selects(app, paths, session_key, user_id):
+    """Request `paths` with `user_id` logged in (under `session_key`);
+    returns {path: [(statement, parameters), ...]} for the SELECTs each
+    one ran."""
+
+    captured = {}
+    current = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            current.append((statement, parameters))
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[session_key] = user_id
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        for path in paths:
+            current.clear()
+            client.get(path)
+            captured.setdefault(path, []).extend(current)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    return captured
+
+
+def table_scans(statement, parameters):
+    """Tables that `statement` would read in full, per EXPLAIN."""
+
+    with db.engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            cursor = conn.connection.cursor()
+
+            if conn.dialect.name == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + statement,
+                               parameters)
+                return _postgres_seq_scans(cursor.fetchone()[0][0]['Plan'])
+
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            details = [row[-1] for row in cursor.fetchall()]
+            sorts = any('TEMP B-TREE' in detail for detail in details)
+
+            scans = set()
+            for match in filter(None, map(SQLITE_TABLE_SCAN.match, details)):
+                table, alias = match.group(1), match.group(2) or match.group(1)
+                if not sorts and _sqlite_rowid_limit(statement, alias):
+                    continue
+                scans.add(table)
+            return scans
+        finally:
+            trans.rollback()
+
+
+def _sqlite_rowid_limit(statement, table):
+    """Is `statement` ORDER BY `table`.id ... LIMIT?
+
+    SQLite stores a table in rowid (id) order, so scanning it that way
+    and stopping at the LIMIT reads just the rows returned. Any other
+    ORDER BY ... LIMIT over a scan reads the whole table.
+    """
+
+    return re.search(rf'ORDER BY {table}\.id(?: ASC| DESC)?\s+LIMIT\b',
+                     statement) is not None
+
+
+def _postgres_seq_scans(plan):
+    scans = set()
+    if plan['Node Type'] == 'Seq Scan':
+        scans.add(plan['Relation Name'])
+    for subplan in plan.get('Plans', []):
+        scans |= _postgres_seq_scans(subplan)
+    return scans
+
+
+def check(app, session_key):
+    """EXPLAIN every SELECT the hot pages run, logged in as the sample
+    user under `session_key`.
+
+    Returns [(path, statement, {table, ...}), ...] for the ones that
+    need a table scan (an empty list if they're all indexed).
+    """
+
+    pages = list(HOT_PAGES)
+    if db.engine.dialect.name == 'postgresql':
+        pages += POSTGRES_HOT_PAGES
+
+    params = sample_params()
+    if params['thread_id'] is None:
+        pages = [page for page in pages if '{thread_id}' not in page]
+
+    paths = [page.format(**params) for page in pages]
+    captured = capture_selects(app, paths, session_key, params['user_id'])
+
+    problems = []
+    checked = set()
+    for path in paths:
+        for statement, parameters in captured[path]:
+            if statement in checked:
+                continue
+            checked.add(statement)
+
+            scans = table_scans(statement, parameters)
+            if scans:
+                problems.append((path, statement, scans))
+
+    return problems
@@ -1,20 +1,184 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, FollowersFollowee
+Recreates the tables, then loads each CSV in generator/ that exists
+(users, messages, follows, reactions, threads, dms), using its header
+row as the column list.
 
+On Postgres the files are streamed in with COPY FROM STDIN, with the
+secondary indexes dropped during the load and rebuilt after it. Other
+databases (SQLite) get batched INSERTs instead. Either way, the derived
+counters and thread activity are recomputed at the end.
 
-db.drop_all()
-db.create_all()
+    python seed.py [--dir generator] [--method auto|copy|insert]
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+from itertools import islice
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from flask_migrate import stamp
+from app import app, db
+from models import (User, Thread, MessageReactionCount, PG_TRGM_EXTENSION,
+                    USERNAME_TRGM_INDEX, USERNAME_PREFIX_INDEX)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
+# in foreign key order
+TABLES = ['users', 'messages', 'follows', 'reactions', 'threads', 'dms']
 
-db.session.commit()
+# tables with a serial id, whose sequence has to catch up after COPY
+SERIAL_TABLES = ['users', 'messages', 'threads', 'dms']
+
+INSERT_BATCH_SIZE = 10000
+
+
+def csv_columns(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f))
+
+
+def copy_table(conn, table, path):
+    """Stream `path` into `table` with COPY; returns the rows loaded."""
+
+    columns = ', '.join(csv_columns(path))
+
+    with open(path, newline='') as f:
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER)",
+            f)
+        return cursor.rowcount
+
+
+def insert_table(conn, table, path):
+    """Load `path` into `table` with batched INSERTs; returns the rows
+    loaded. Empty fields become NULLs, as with COPY."""
+
+    table = db.metadata.tables[table]
+    dates = {column.name for column in table.columns
+             if isinstance(column.type, db.DateTime)}
+
+    def convert(row):
+        return {name: (None if value == '' else
+                       datetime.fromisoformat(value) if name in dates else
+                       value)
+                for name, value in row.items()}
+
+    count = 0
+    with open(path, newline='') as f:
+        rows = map(convert, csv.DictReader(f))
+        while True:
+            batch = list(islice(rows, INSERT_BATCH_SIZE))
+            if not batch:
+                return count
+            conn.execute(table.insert(), batch)
+            count += len(batch)
+
+
+def secondary_indexes():
+    return [index
+            for table in db.metadata.sorted_tables
+            for index in table.indexes]
+
+
+def drop_indexes(conn):
+    for index in secondary_indexes():
+        index.drop(conn)
+    conn.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+    conn.execute("DROP INDEX IF EXISTS ix_users_username_lower_prefix")
+
+
+def create_indexes(conn):
+    for index in secondary_indexes():
+        index.create(conn)
+    conn.execute(PG_TRGM_EXTENSION)
+    conn.execute(USERNAME_TRGM_INDEX)
+    conn.execute(USERNAME_PREFIX_INDEX)
+
+
+def reset_sequences(conn):
+    for table in SERIAL_TABLES:
+        conn.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table}")
+
+
+def timed(label, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+
+    if isinstance(result, int):
+        print(f"{label:<24} {result:>12,} rows {elapsed:>8.1f}s "
+              f"{result / max(elapsed, 1e-9):>12,.0f} rows/s")
+    else:
+        print(f"{label:<24} {'':>17} {elapsed:>8.1f}s")
+
+    return result
+
+
+def seed(directory, method):
+    paths = [(table, os.path.join(directory, f"{table}.csv"))
+             for table in TABLES]
+    paths = [(table, path) for table, path in paths if os.path.exists(path)]
+
+    db.drop_all()
+    db.create_all()
+
+    # create_all made the latest schema; record that, so `flask db upgrade`
+    # only runs migrations added after this
+    with app.app_context():
+        stamp()
+
+    start = time.perf_counter()
+    total = 0
+
+    with db.engine.begin() as conn:
+        if method == 'copy':
+            timed("drop indexes", drop_indexes, conn)
+            for table, path in paths:
+                total += timed(table, copy_table, conn, table, path)
+            timed("create indexes", create_indexes, conn)
+            reset_sequences(conn)
+        else:
+            for table, path in paths:
+                total += timed(table, insert_table, conn, table, path)
+
+    timed("counters", recompute_derived)
+
+    if method == 'copy':
+        with db.engine.connect() as conn:
+            timed("analyze", conn.execute,
+                  db.text("ANALYZE").execution_options(autocommit=True))
+
+    elapsed = time.perf_counter() - start
+    print(f"{'total':<24} {total:>12,} rows {elapsed:>8.1f}s "
+          f"{total / max(elapsed, 1e-9):>12,.0f} rows/s")
+
+
+def recompute_derived():
+    User.repair_counters()
+    Thread.backfill_last_dm()
+    MessageReactionCount.reconcile()
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding the CSVs")
+    parser.add_argument('--method', choices=['auto', 'copy', 'insert'],
+                        default='auto',
+                        help="copy needs Postgres; auto uses it if it can")
+    args = parser.parse_args()
+
+    method = args.method
+    if method == 'auto':
+        method = 'copy' if db.engine.dialect.name == 'postgresql' else 'insert'
+
+    seed(args.dir, method)
+
+
+if __name__ == '__main__':
+    main()
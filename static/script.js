@@ -29,15 +29,37 @@ $(document).ready(function() {
       .parent()
       .attr('id');
     $(evt.target).toggleClass('far fas');
-    if ($(evt.target).hasClass('fas')) {
-      addReaction(type, msgId, function(resp) {
-        console.log(resp);
-      });
-    } else {
-      deleteReaction(type, msgId, function(resp) {
-        console.log(resp);
-      });
-    }
+    let $count = $(evt.target).next('.reaction-count');
+    let total =
+      (parseInt($count.text()) || 0) +
+      ($(evt.target).hasClass('fas') ? 1 : -1);
+    $count.text(total > 0 ? total : '');
+    queueReaction(type, msgId, $(evt.target).hasClass('fas'));
+  });
+
+  let $dmList = $('.dm-list');
+  if ($dmList.length) {
+    streamDMs(
+      $dmList.data('thread-id'),
+      $dmList.data('user-id'),
+      $dmList.data('last-id')
+    );
+  }
+
+  $('#dm-older').on('click', function(evt) {
+    let $button = $(evt.target);
+    loadOlderDMs(
+      $dmList.data('thread-id'),
+      $dmList.data('user-id'),
+      $button.data('before'),
+      function(before) {
+        if (before) {
+          $button.data('before', before);
+        } else {
+          $button.remove();
+        }
+      }
+    );
   });
 
   $('#dm-form').on('submit', function(evt) {
@@ -66,28 +88,60 @@ $(document).ready(function() {
 //   });
 // }
 
-function addReaction(type, msgId, cb) {
+// Reaction clicks wait here briefly and go out together in one batch;
+// clicking the same icon again before then just changes what's sent.
+const REACTION_ICONS = {
+  smile: 'fa-smile',
+  sad: 'fa-sad-cry',
+  laugh: 'fa-laugh-squint',
+  angry: 'fa-angry'
+};
+const REACTION_BATCH_DELAY = 400;
+let pendingReactions = {};
+let reactionTimer = null;
+
+function queueReaction(type, msgId, on) {
+  pendingReactions[`${msgId}:${type}`] = { msgId: +msgId, type, on };
+  clearTimeout(reactionTimer);
+  reactionTimer = setTimeout(sendReactions, REACTION_BATCH_DELAY);
+}
+
+function sendReactions(retries = 3) {
+  let ops = Object.values(pendingReactions);
+  pendingReactions = {};
+  if (!ops.length) {
+    return;
+  }
+
   $.ajax({
     method: 'POST',
-    url: `${BASE_URL}/addreaction`,
+    url: `${BASE_URL}/reactions/batch`,
     contentType: 'application/json',
-    data: JSON.stringify({ type, msgId }),
-    success: response => {
-      cb(response);
+    data: JSON.stringify({ ops }),
+    success: response => response.reactions.forEach(showReaction),
+    error: () => {
+      // batches only set state, so resending is safe; newer clicks on
+      // the same reaction take precedence
+      if (retries > 0) {
+        ops.forEach(op => {
+          let key = `${op.msgId}:${op.type}`;
+          pendingReactions[key] = pendingReactions[key] || op;
+        });
+        setTimeout(() => sendReactions(retries - 1), REACTION_BATCH_DELAY);
+      }
     }
   });
 }
 
-function deleteReaction(type, msgId, cb) {
-  $.ajax({
-    method: 'DELETE',
-    url: `${BASE_URL}/deletereaction`,
-    contentType: 'application/json',
-    data: JSON.stringify({ type, msgId }),
-    success: response => {
-      cb(response);
-    }
-  });
+// Show the server's view of a reaction, unless it's been clicked again
+// since the batch went out.
+function showReaction(reaction) {
+  if (pendingReactions[`${reaction.msgId}:${reaction.type}`]) {
+    return;
+  }
+  let $icon = $(`li[id="${reaction.msgId}"] .${REACTION_ICONS[reaction.type]}`);
+  $icon.toggleClass('fas', reaction.on).toggleClass('far', !reaction.on);
+  $icon.next('.reaction-count').text(reaction.count || '');
 }
 
 function addDM(text, threadId, cb) {
@@ -103,3 +157,51 @@ function addDM(text, threadId, cb) {
   // append it to the dom
   $('.dm-list').append($(`<div class="my dm-row ml-auto">${text}</div>`));
 }
+
+// Listen for new DMs in this thread and show the ones from the other user
+// (our own are added as soon as we send them).
+function streamDMs(threadId, userId, lastId) {
+  let source = new EventSource(`${BASE_URL}/threads/${threadId}/stream`);
+
+  source.onmessage = function(evt) {
+    let dm = JSON.parse(evt.data);
+    if (dm.id <= lastId) {
+      return;
+    }
+
+    if (dm.text === undefined) {
+      // too big to push: fetch it (and anything else we missed)
+      $.getJSON(`${BASE_URL}/threads/${threadId}/dms`, { after: lastId }, dms =>
+        dms.forEach(showDM)
+      );
+    } else {
+      showDM(dm);
+    }
+  };
+
+  function showDM(dm) {
+    if (dm.id <= lastId) {
+      return;
+    }
+    lastId = dm.id;
+    if (dm.author !== userId) {
+      $('.dm-list').append(
+        $('<div class="their dm-row"></div>').text(dm.text)
+      );
+    }
+  }
+}
+
+// Fetch the page of DMs before the `before` cursor and put it above the
+// ones we're showing; cb gets the cursor for the page before that.
+function loadOlderDMs(threadId, userId, before, cb) {
+  $.getJSON(`${BASE_URL}/threads/${threadId}/history`, { before }, response => {
+    let rows = response.dms.map(dm =>
+      $('<div class="dm-row"></div>')
+        .addClass(dm.author === userId ? 'my ml-auto' : 'their')
+        .text(dm.text)
+    );
+    $('.dm-list').prepend(rows);
+    cb(response.before);
+  });
+}
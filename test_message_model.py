@@ -6,10 +6,11 @@
 
 
 import os
+import time
 from unittest import TestCase
 from datetime import datetime
 
-from models import db, User, Message, FollowersFollowee, Reaction
+from models import db, User, Message, MessageRow, FollowersFollowee, Reaction
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -67,6 +68,54 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(m.user_id, 1)
         self.assertTrue(m.timestamp<=datetime.utcnow())
 
+    def test_message_timestamps(self):
+        """Are messages stamped by the database when they're inserted?"""
+
+        User.signup(username="testuser", email="test@test.com",
+                    password="HASHED_PASSWORD", image_url=None)
+        db.session.commit()
+        user_id = User.query.one().id
+
+        timestamps = []
+        for text in ["first", "second"]:
+            m = Message(text=text, user_id=user_id)
+            db.session.add(m)
+            db.session.flush()
+            # read back on insert, not left for a later query
+            self.assertIn('timestamp', m.__dict__)
+            timestamps.append(m.timestamp)
+            db.session.commit()
+            time.sleep(0.01)
+
+        self.assertLess(timestamps[0], timestamps[1])
+        self.assertLess(abs(timestamps[1] - datetime.utcnow()).total_seconds(), 60)
+
+    def test_message_rows(self):
+        """Do MessageRows page like Messages, with their authors?"""
+
+        u = User.signup(username="testuser", email="test@test.com",
+                        password="HASHED_PASSWORD", image_url=None)
+        db.session.commit()
+        db.session.add_all([
+            Message(text=text, user_id=u.id,
+                    timestamp=datetime(2019, 1, day))
+            for day, text in enumerate(["one", "two", "three"], 1)])
+        db.session.commit()
+
+        messages = Message.page(Message.query, limit=2)
+        rows = MessageRow.page(Message.query, limit=2)
+
+        self.assertEqual([r.text for r in rows], ["three", "two"])
+        self.assertEqual([r.cursor for r in rows],
+                         [m.cursor for m in messages])
+        self.assertEqual((rows[0].user.id, rows[0].user.username),
+                         (u.id, "testuser"))
+        self.assertFalse(hasattr(rows[0], '__dict__'))
+
+        older = MessageRow.page(Message.query,
+                                Message.parse_cursor(rows[-1].cursor))
+        self.assertEqual([r.text for r in older], ["one"])
+
 
     
     def tearDown(self):
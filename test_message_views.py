@@ -6,9 +6,13 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+import models
+from models import (db, connect_db, Message, User, FollowersFollowee,
+                    Reaction, Timeline, TimelineEntry)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -32,6 +36,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Reload the logged-in user on every request, since each test reuses ids
+
+app.config['USER_CACHE_TTL'] = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -118,4 +126,288 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(len(new_message_list), 1)
 
+    def test_destroy_message_with_reactions(self):
+        """Does deleting a message take its reactions with it, and off
+        the reacting users' counters?"""
+
+        fan = User.signup(username="fan", email="fan@test.com",
+                          password="testuser", image_url=None)
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        other = Message(text="Hello2", user_id=self.testuser.id)
+        db.session.add_all([msg, other])
+        db.session.commit()
+        user_id, fan_id, msg_id = self.testuser.id, fan.id, msg.id
+
+        Reaction.add(fan_id, msg_id, 'like')
+        Reaction.add(fan_id, msg_id, 'laugh')
+        Reaction.add(fan_id, other.id, 'like')
+        Reaction.add(user_id, msg_id, 'like')
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        resp = self.client.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(Message.query.get(msg_id))
+        self.assertEqual(Reaction.query.count(), 1)
+        self.assertEqual(User.query.get(fan_id).reactions_count, 1)
+        self.assertEqual(User.query.get(user_id).reactions_count, 0)
+
+    def test_homepage_builds_timeline(self):
+        """Does the homepage build the timeline on a cache miss?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            self.assertIsNone(Timeline.query.get(self.testuser.id))
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNotNone(Timeline.query.get(self.testuser.id))
+
+    def test_add_message_fans_out(self):
+        """Does a new message reach followers' timelines, and leave them
+        when deleted?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="testuser",
+                               image_url=None)
+        db.session.commit()
+        user_id = self.testuser.id
+        follower_id = follower.id
+        db.session.add(FollowersFollowee(followee_id=follower_id,
+                                         follower_id=user_id))
+        Timeline.rebuild(follower_id)
+        Timeline.rebuild(user_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            msg = Message.query.one()
+
+            entries = TimelineEntry.query.filter_by(message_id=msg.id).all()
+            self.assertEqual({e.user_id for e in entries},
+                             {user_id, follower_id})
+            self.assertEqual(
+                [m.id for m in Timeline.messages_for(follower_id, 100)],
+                [msg.id])
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+            self.assertEqual(Timeline.messages_for(follower_id, 100), [])
+
+    def test_follow_self(self):
+        """Does following and unfollowing yourself leave your timeline
+        alone?"""
+
+        user_id = self.testuser.id
+        db.session.add(Message(text="mine", user_id=user_id))
+        Timeline.rebuild(user_id)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        resp = self.client.post(f"/users/follow/{user_id}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+        resp = self.client.post(f"/users/stop-following/{user_id}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual([m.text for m in Timeline.messages_for(user_id, 100)],
+                         ["mine"])
+
+    def test_rebuild_twice(self):
+        """Does rebuilding a timeline that's already built replace it
+        rather than fail on the entries and timelines row already there?"""
+
+        user_id = self.testuser.id
+        db.session.add(Message(text="mine", user_id=user_id))
+        Timeline.rebuild(user_id)
+        db.session.commit()
+
+        Timeline.rebuild(user_id)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 1)
+        self.assertTrue(Timeline.query.get(user_id).complete)
+
+    def test_timeline_trim(self):
+        """Are only timelines past the cap and slack trimmed, newest kept
+        first by (timestamp, message id), and not on posting?"""
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        user_id, other_id = self.testuser.id, other.id
+        same_time = datetime(2019, 1, 1)
+        db.session.add_all([
+            Message(id=1, text="old", user_id=user_id,
+                    timestamp=datetime(2018, 1, 1)),
+            Message(id=2, text="tie one", user_id=user_id,
+                    timestamp=same_time),
+            Message(id=3, text="tie two", user_id=user_id,
+                    timestamp=same_time),
+            Message(id=4, text="other's", user_id=other_id,
+                    timestamp=same_time),
+        ])
+        Timeline.rebuild(user_id)
+        Timeline.rebuild(other_id)
+        db.session.commit()
+
+        models.TIMELINE_LENGTH, length = 1, models.TIMELINE_LENGTH
+        try:
+            # posting leaves it to grow; within the slack it's left alone
+            msg = Message(id=5, text="new", user_id=user_id,
+                          timestamp=datetime(2017, 1, 1))
+            db.session.add(msg)
+            db.session.flush()
+            Timeline.fan_out(msg)
+            self.assertEqual(TimelineEntry.trim([user_id], slack=3), 0)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=user_id).count(), 4)
+
+            self.assertEqual(TimelineEntry.trim([user_id, other_id],
+                                                slack=2), 1)
+            db.session.commit()
+        finally:
+            models.TIMELINE_LENGTH = length
+
+        self.assertEqual(
+            {e.message_id for e in
+             TimelineEntry.query.filter_by(user_id=user_id)}, {3})
+        self.assertFalse(Timeline.query.get(user_id).complete)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=other_id).count(), 1)
+        self.assertTrue(Timeline.query.get(other_id).complete)
+
+    def test_homepage_pages(self):
+        """Does the home feed page, from the timeline and the fallback?"""
+
+        user_id = self.testuser.id
+        same_time = datetime(2019, 1, 1)
+        db.session.add_all([
+            Message(id=1, text="oldest", user_id=user_id,
+                    timestamp=datetime(2018, 1, 1)),
+            Message(id=2, text="tie one", user_id=user_id,
+                    timestamp=same_time),
+            Message(id=3, text="tie two", user_id=user_id,
+                    timestamp=same_time),
+        ])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                # first visit misses the timeline, second one reads it
+                for _ in range(2):
+                    resp = c.get("/")
+                    self.assertIn(b'tie two', resp.data)
+                    self.assertIn(b'tie one', resp.data)
+                    self.assertNotIn(b'oldest', resp.data)
+                    self.assertIn(b'?before=2019-01-01T00%3A00%3A00_2',
+                                  resp.data)
+
+                resp = c.get("/?before=2019-01-01T00:00:00_2")
+                self.assertIn(b'oldest', resp.data)
+                self.assertNotIn(b'tie', resp.data)
+                self.assertNotIn(b'Older', resp.data)
+
+                # a trimmed timeline hands its last page to the slow query
+                Timeline.query.get(user_id).complete = False
+                TimelineEntry.query.filter_by(message_id=1).delete()
+                db.session.commit()
+
+                resp = c.get("/?before=2019-01-01T00:00:00_2")
+                self.assertIn(b'oldest', resp.data)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_follow_prolific_author(self):
+        """After following someone with more messages than a timeline
+        holds, can the home feed still be paged back to their oldest?"""
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="testuser", image_url=None)
+        db.session.commit()
+        user_id, author_id = self.testuser.id, author.id
+        db.session.add_all([
+            Message(id=n, text=f"m{n}", user_id=author_id,
+                    timestamp=datetime(2019, 1, n))
+            for n in range(1, 7)])
+        Timeline.rebuild(user_id)
+        db.session.commit()
+
+        models.TIMELINE_LENGTH, length = 3, models.TIMELINE_LENGTH
+        app.config['MESSAGES_PER_PAGE'] = 3
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                c.post(f"/users/follow/{author_id}")
+                self.assertFalse(Timeline.query.get(user_id).complete)
+
+                resp = c.get("/")
+                self.assertIn(b'm4', resp.data)
+                self.assertNotIn(b'm3', resp.data)
+
+                resp = c.get("/?before=2019-01-04T00:00:00_4")
+                self.assertIn(b'm3', resp.data)
+                self.assertIn(b'm1', resp.data)
+        finally:
+            models.TIMELINE_LENGTH = length
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_homepage_query_count(self):
+        """Are the authors of a feed page loaded together, so the page
+        runs as many queries whatever its size?"""
+
+        user_id = self.testuser.id
+        for n in range(10):
+            author = User.signup(username=f"author{n}",
+                                 email=f"author{n}@test.com",
+                                 password="testuser",
+                                 image_url=None)
+            db.session.flush()
+            db.session.add(Message(text=f"message {n}", user_id=author.id))
+            db.session.add(FollowersFollowee(followee_id=user_id,
+                                             follower_id=author.id))
+        db.session.commit()
 
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        def count_queries(per_page, timeline):
+            if not timeline:
+                Timeline.query.filter_by(user_id=user_id).delete()
+                db.session.commit()
+
+            app.config['MESSAGES_PER_PAGE'] = per_page
+            # nothing left over in the identity map to hide lazy loads
+            db.session.expunge_all()
+            resp = self.client.get("/")
+            self.assertEqual(resp.data.count(b'class="timeline-image"'),
+                             per_page)
+            return int(re.search(r'"(\d+) queries"',
+                                 resp.headers['Server-Timing']).group(1))
+
+        try:
+            # from the slow query, and from the timeline
+            for timeline in [False, True]:
+                self.assertEqual(count_queries(2, timeline),
+                                 count_queries(10, timeline))
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, FollowersFollowee, Reaction
+from models import db, User, Message, FollowersFollowee, Reaction, bcrypt
+from passwords import hash_cost
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -68,6 +69,19 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u.followers.count(), 1)
         self.assertEqual(u.following.count(), 1)
 
+        # stored counters only catch up after a repair
+        self.assertEqual(u.messages_count, 0)
+        User.repair_counters()
+        db.session.commit()
+        self.assertEqual(u.messages_count, 1)
+        self.assertEqual(u.followers_count, 1)
+        self.assertEqual(u.following_count, 1)
+        self.assertEqual(u.reactions_count, 1)
+
+        # test get following ids
+        self.assertEqual(u.get_following_ids([1, 2, 3]), {2})
+        self.assertEqual(u.get_following_ids([]), set())
+
         db.session.delete(f)
         db.session.commit()
 
@@ -100,6 +114,13 @@ class UserModelTestCase(TestCase):
         # test get my messages
         self.assertEqual(len(u.get_my_messages()), 1)
 
+        # test get reaction state
+        reactions, my_msgs = u.get_reaction_state([1])
+        self.assertEqual(reactions, {"sad": {1}})
+        self.assertEqual(my_msgs, {1})
+        self.assertEqual(u2.get_reaction_state([1]), ({}, set()))
+        self.assertEqual(u.get_reaction_state([]), ({}, set()))
+
         # test auth
         u = User.authenticate(u.username, "HASHED_PASSWORD")
         self.assertTrue(u)
@@ -107,6 +128,40 @@ class UserModelTestCase(TestCase):
         u = User.authenticate(u.username, "asdfasdf")
         self.assertFalse(u)
 
+    def test_authenticate_rehashes(self):
+        """Are hashes at an old cost upgraded on login?"""
+
+        old_hash = bcrypt.generate_password_hash("password", 4).decode('UTF-8')
+        u = User(username="testuser", email="test@test.com",
+                 password=old_hash)
+        db.session.add(u)
+        db.session.commit()
+
+        self.assertEqual(User.authenticate("testuser", "password"), u)
+        db.session.commit()
+
+        self.assertEqual(hash_cost(u.password), app.config['BCRYPT_LOG_ROUNDS'])
+        self.assertTrue(User.authenticate("testuser", "password"))
+
+    def test_search(self):
+        """Does search rank exact, then prefix, then substring matches?"""
+
+        for i, username in enumerate(["xtestuser", "testuser2", "testuser",
+                                      "other", "test_user"]):
+            User.signup(username=username, email=f"{i}@test.com",
+                        password="HASHED_PASSWORD", image_url=None)
+        db.session.commit()
+
+        self.assertEqual([u.username for u in User.search("testuser", 10)],
+                         ["testuser", "testuser2", "xtestuser"])
+        self.assertEqual([u.username for u in User.search("test_", 10)],
+                         ["test_user"])
+        self.assertEqual([u.username for u in User.search("ot", 10)],
+                         ["other"])
+        self.assertEqual([u.username for u in User.search("OT", 10)],
+                         ["other"])
+        self.assertEqual(User.search("er", 10), [])
+
     def tearDown(self):
         User.query.delete()
         Message.query.delete()
@@ -5,10 +5,14 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
 import os
+import re
+import threading
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, FollowersFollowee, Reaction, Message
+from models import db, connect_db, Message, User, FollowersFollowee, Reaction, MessageReactionCount, Message, Timeline, TimelineEntry, Thread, DM
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +24,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_cache, forget_cached_user
+from instrumentation import fingerprint
+from models import hasher
+import query_plans
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +39,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Reload the logged-in user on every request, since each test reuses ids
+
+app.config['USER_CACHE_TTL'] = 0
+
 
 class UserViewTestCase(TestCase):
     """Test views for user."""
@@ -105,6 +116,71 @@ class UserViewTestCase(TestCase):
             #  Make sure it redirects
             self.assertEqual(resp.status_code, 302)
 
+    def test_login_when_busy(self):
+        """Are logins turned away when the hashing pool is saturated?"""
+        slots = hasher.slots
+        hasher.slots = threading.BoundedSemaphore(1)
+        hasher.slots.acquire()
+
+        try:
+            with self.client as c:
+                resp = c.post(
+                    "/login", data={"username": "testuser", "password": "testuser"})
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers['Retry-After'], '1')
+        finally:
+            hasher.slots = slots
+
+    def test_busy_hashing_leaves_other_pages_alone(self):
+        """With every hashing slot taken by logins, is a further login
+        turned away while other pages are still served?"""
+
+        pending = app.config['BCRYPT_MAX_PENDING']
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        check = hasher.bcrypt.check_password_hash
+
+        def slow_check(pw_hash, password):
+            started.release()
+            release.wait(10)
+            return check(pw_hash, password)
+
+        statuses = []
+
+        def login():
+            resp = app.test_client().post(
+                "/login", data={"username": "testuser", "password": "testuser"})
+            statuses.append(resp.status_code)
+
+        hasher.bcrypt.check_password_hash = slow_check
+        logins = [threading.Thread(target=login) for _ in range(pending)]
+
+        try:
+            for thread in logins:
+                thread.start()
+            # each login holds its slot until released (there are as many
+            # bcrypt workers as slots, so every one of them gets this far)
+            for _ in range(pending):
+                self.assertTrue(started.acquire(timeout=10))
+
+            with self.client as c:
+                resp = c.post(
+                    "/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 503)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                resp = c.get("/users")
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            release.set()
+            for thread in logins:
+                thread.join()
+            del hasher.bcrypt.check_password_hash
+
+        self.assertEqual(statuses, [302] * pending)
+
     def test_logout(self):
         """Can logout?"""
         with self.client as c:
@@ -129,6 +205,29 @@ class UserViewTestCase(TestCase):
             resp = c.get('/users?q=testuser')
             self.assertIn(b'testuser', resp.data)
 
+    def test_list_users_pages(self):
+        """Does the user listing page, and show follow state?"""
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get('/users')
+                self.assertIn(b'@testuser2', resp.data)
+                self.assertIn(b'/users/stop-following/2', resp.data)
+                self.assertNotIn(b'@testuser4', resp.data)
+                self.assertIn(b'/users?after=2', resp.data)
+
+                resp = c.get('/users?after=2')
+                self.assertIn(b'@testuser4', resp.data)
+                self.assertIn(b'/users/follow/4', resp.data)
+                self.assertNotIn(b'@testuser2', resp.data)
+                self.assertNotIn(b'/users?after=', resp.data)
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
     def test_show_user(self):
         """Can show user?"""
         with self.client as c:
@@ -140,6 +239,40 @@ class UserViewTestCase(TestCase):
             self.assertIn(b'testuser', resp.data)
             self.assertIn(b'Edit Profile', resp.data)
 
+    def test_show_user_pages(self):
+        """Does the profile page its messages, including timestamp ties?"""
+        same_time = datetime(2019, 1, 1)
+        db.session.add_all([
+            Message(id=2, text="oldest", user_id=1,
+                    timestamp=datetime(2018, 1, 1)),
+            Message(id=3, text="tie one", user_id=1, timestamp=same_time),
+            Message(id=4, text="tie two", user_id=1, timestamp=same_time),
+        ])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get('/users/1')
+                self.assertIn(b'tie two', resp.data)
+                self.assertIn(b'tie one', resp.data)
+                self.assertNotIn(b'oldest', resp.data)
+                self.assertIn(b'?before=2019-01-01T00%3A00%3A00_3', resp.data)
+
+                resp = c.get('/users/1?before=2019-01-01T00:00:00_4')
+                self.assertIn(b'tie one', resp.data)
+                self.assertIn(b'oldest', resp.data)
+                self.assertNotIn(b'tie two', resp.data)
+                self.assertNotIn(b'Older', resp.data)
+
+                resp = c.get('/users/1?before=nonsense')
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
     def test_following_user(self):
         """Can show following user?"""
         with self.client as c:
@@ -170,6 +303,311 @@ class UserViewTestCase(TestCase):
             resp = c.get(f'/users/{self.testuser.id}/reactions')
             self.assertIn(b'test message', resp.data)
 
+    def test_user_cache(self):
+        """Is the logged-in user reused across requests until forgotten?"""
+        app.config['USER_CACHE_TTL'] = 60
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.get('/')
+                User.query.filter_by(id=1).update({'username': 'renamed'})
+                db.session.commit()
+
+                resp = c.get('/')
+                self.assertIn(b'@testuser<', resp.data)
+
+                forget_cached_user(1)
+                resp = c.get('/')
+                self.assertIn(b'@renamed<', resp.data)
+        finally:
+            app.config['USER_CACHE_TTL'] = 0
+            user_cache.clear()
+
+    def test_add_reaction(self):
+        """Can react with only the user id from the session?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post('/addreaction', json={"type": "smile", "msgId": 1})
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(Reaction.query.get((1, 1, "smile")))
+            self.assertEqual(MessageReactionCount.query.get((1, "smile")).count, 1)
+
+            resp = c.delete('/deletereaction',
+                            json={"type": "smile", "msgId": 1})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(Reaction.query.get((1, 1, "smile")))
+            self.assertEqual(MessageReactionCount.query.get((1, "smile")).count, 0)
+
+    def test_reactions_repeat_safely(self):
+        """Are repeated adds and deletes of a reaction harmless?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            for _ in range(2):
+                resp = c.post('/addreaction', json={"type": "smile", "msgId": 1})
+                self.assertEqual(resp.status_code, 200)
+            self.assertEqual(User.query.get(4).reactions_count, 1)
+
+            for _ in range(2):
+                resp = c.delete('/deletereaction',
+                                json={"type": "smile", "msgId": 1})
+                self.assertEqual(resp.status_code, 200)
+            self.assertEqual(User.query.get(4).reactions_count, 0)
+
+    def test_batch_reactions(self):
+        """Does a batch apply the last op per reaction and report totals?"""
+        MessageReactionCount.reconcile()
+        db.session.commit()
+
+        ops = [{"msgId": 1, "type": "smile", "on": True},
+               {"msgId": 1, "type": "sad", "on": True},
+               {"msgId": 1, "type": "laugh", "on": True},
+               {"msgId": 1, "type": "laugh", "on": False},
+               {"msgId": 99, "type": "smile", "on": True}]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            # sent twice, as a retry would
+            for _ in range(2):
+                resp = c.post('/reactions/batch', json={"ops": ops})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json["reactions"], [
+                    {"msgId": 1, "type": "laugh", "on": False, "count": 0},
+                    {"msgId": 1, "type": "sad", "on": True, "count": 2},
+                    {"msgId": 1, "type": "smile", "on": True, "count": 1}])
+
+            self.assertEqual(Reaction.query.filter_by(user_id=4).count(), 2)
+            self.assertEqual(User.query.get(4).reactions_count, 2)
+
+            resp = c.post('/reactions/batch', json={"ops": [
+                {"msgId": 1, "type": "sad", "on": False}]})
+            self.assertEqual(resp.json["reactions"][0]["count"], 1)
+
+            resp = c.post('/reactions/batch', json={"ops": [
+                {"msgId": 1, "type": "meh", "on": True}]})
+            self.assertEqual(resp.status_code, 400)
+            resp = c.post('/reactions/batch', json={"ops": [{"msgId": 1}]})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_reaction_counts(self):
+        """Are reaction totals reconciled and shown on the timeline?"""
+        # the setUp reaction went straight into the table, uncounted
+        self.assertEqual(MessageReactionCount.reconcile(), 1)
+        db.session.commit()
+        self.assertEqual(MessageReactionCount.reconcile(), 0)
+        self.assertEqual(MessageReactionCount.totals_for([1]),
+                         {"sad": {1: 1}})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            c.post('/addreaction', json={"type": "sad", "msgId": 1})
+            c.post('/users/follow/2')
+
+            resp = c.get('/')
+            self.assertIn(b'<span class="reaction-count">2</span>', resp.data)
+
+            # deleting a user takes their reactions off the totals
+            c.post('/users/delete')
+            self.assertEqual(MessageReactionCount.totals_for([1]),
+                             {"sad": {1: 1}})
+
+    def test_reactions_query_count(self):
+        """Does the reactions page load the messages' authors together,
+        so it runs as many queries however many reactions there are?"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        def count_queries():
+            # nothing left over in the identity map to hide lazy loads
+            db.session.expunge_all()
+            resp = self.client.get('/users/1/reactions')
+            return int(re.search(r'"(\d+) queries"',
+                                 resp.headers['Server-Timing']).group(1))
+
+        one_reaction = count_queries()
+
+        for n in range(5):
+            author = User.signup(username=f"author{n}",
+                                 email=f"author{n}@test.com",
+                                 password="testuser",
+                                 image_url=None)
+            db.session.flush()
+            message = Message(text=f"message {n}", user_id=author.id)
+            db.session.add(message)
+            db.session.flush()
+            Reaction.add(1, message.id, "smile")
+        db.session.commit()
+
+        self.assertEqual(count_queries(), one_reaction)
+
+    def test_add_thread(self):
+        """Does starting a thread reuse the one for the pair either way?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            resp = c.post('/threads/add/1')
+            thread = Thread.query.one()
+            self.assertEqual((thread.user1_id, thread.user2_id), (1, 2))
+            self.assertTrue(resp.location.endswith(f'/threads/{thread.id}'))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post('/threads/add/2')
+            self.assertEqual(Thread.query.count(), 1)
+            self.assertTrue(resp.location.endswith(f'/threads/{thread.id}'))
+
+    def test_list_threads(self):
+        """Does the inbox show the other user and latest DM, newest first?"""
+        quiet = Thread(user1_id=1, user2_id=4,
+                       last_activity_at=datetime(2018, 1, 1))
+        busy = Thread(user1_id=1, user2_id=2)
+        db.session.add_all([quiet, busy])
+        db.session.commit()
+        busy_id = busy.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.post(f'/threads/{busy_id}/dm/add', json={"text": "first"})
+            c.post(f'/threads/{busy_id}/dm/add', json={"text": "latest"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get('/threads')
+            html = resp.data.decode()
+            self.assertIn('latest', html)
+            self.assertNotIn('first', html)
+            self.assertLess(html.index('testuser2'), html.index('testuser4'))
+
+    def test_record_dm_out_of_order(self):
+        """Does recording an earlier DM after a later one leave the later
+        one as the thread's latest?"""
+        thread = Thread(user1_id=1, user2_id=2)
+        db.session.add(thread)
+        db.session.flush()
+        earlier = DM(thread_id=thread.id, author=1, text="earlier")
+        later = DM(thread_id=thread.id, author=2, text="later")
+        db.session.add_all([earlier, later])
+        db.session.flush()
+
+        Thread.record_dm(later)
+        Thread.record_dm(earlier)
+        db.session.commit()
+
+        self.assertEqual(Thread.query.get(thread.id).last_dm_id, later.id)
+
+    def test_add_and_sync_dms(self):
+        """Does adding a DM return just it, and can clients fetch newer?"""
+        thread = Thread(user1_id=1, user2_id=2)
+        db.session.add(thread)
+        db.session.commit()
+        thread_id = thread.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            first = c.post(f'/threads/{thread_id}/dm/add',
+                           json={"text": "first"}).json
+            resp = c.post(f'/threads/{thread_id}/dm/add',
+                          json={"text": "second"})
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(resp.json['text'], "second")
+            self.assertEqual(resp.json['author'], 1)
+
+            resp = c.get(f'/threads/{thread_id}/dms?after={first["id"]}')
+            self.assertEqual([dm['text'] for dm in resp.json], ["second"])
+
+            resp = c.get(f'/threads/{thread_id}/dms')
+            self.assertEqual([dm['text'] for dm in resp.json],
+                             ["first", "second"])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            resp = c.get(f'/threads/{thread_id}/dms')
+            self.assertEqual(resp.status_code, 403)
+
+    def test_thread_pages(self):
+        """Does a thread show its latest DMs and page back through older?"""
+        thread = Thread(user1_id=1, user2_id=2)
+        db.session.add(thread)
+        db.session.commit()
+        same_time = datetime(2019, 1, 1)
+        db.session.add_all([
+            DM(id=1, text="dm-oldest", thread_id=thread.id, author=1,
+               timestamp=datetime(2018, 1, 1)),
+            DM(id=2, text="dm-tie-one", thread_id=thread.id, author=2,
+               timestamp=same_time),
+            DM(id=3, text="dm-tie-two", thread_id=thread.id, author=1,
+               timestamp=same_time),
+        ])
+        db.session.commit()
+        thread_id = thread.id
+        app.config['DMS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+
+                html = c.get(f'/threads/{thread_id}').data.decode()
+                self.assertNotIn('dm-oldest', html)
+                self.assertLess(html.index('dm-tie-one'),
+                                html.index('dm-tie-two'))
+                self.assertIn('data-before="2019-01-01T00:00:00_2"', html)
+
+                resp = c.get(f'/threads/{thread_id}/history'
+                             '?before=2019-01-01T00:00:00_2')
+                self.assertEqual([dm['text'] for dm in resp.json['dms']],
+                                 ["dm-oldest"])
+                self.assertIsNone(resp.json['before'])
+        finally:
+            app.config['DMS_PER_PAGE'] = 50
+
+    def test_stream_dms(self):
+        """Are new DMs pushed to an open stream, and missed ones replayed?"""
+        thread = Thread(user1_id=1, user2_id=2)
+        db.session.add(thread)
+        db.session.commit()
+        thread_id = thread.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            first = c.post(f'/threads/{thread_id}/dm/add',
+                           json={"text": "missed"}).json
+
+            resp = c.get(f'/threads/{thread_id}/stream',
+                         headers={'Last-Event-ID': str(first['id'] - 1)})
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            events = iter(resp.response)
+            self.assertEqual(next(events), b"retry: 3000\n\n")
+
+            second = c.post(f'/threads/{thread_id}/dm/add',
+                            json={"text": "pushed"}).json
+
+            for dm in [first, second]:
+                event_id, data = next(events).decode().split('\n')[:2]
+                self.assertEqual(event_id, f"id: {dm['id']}")
+                self.assertEqual(json.loads(data[len('data: '):]), dm)
+            resp.close()
+
     def test_follow(self):
         """Can follow?"""
         with self.client as c:
@@ -192,6 +630,135 @@ class UserViewTestCase(TestCase):
             followerfollowee = FollowersFollowee.query.all()
             self.assertEqual(len(followerfollowee), 1)
 
+    def test_follow_counters(self):
+        """Do follows/unfollows keep the stored counters up to date?"""
+        User.repair_counters()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/4')
+            c.post('/users/follow/4')
+            self.assertEqual(User.query.get(1).following_count, 2)
+            self.assertEqual(User.query.get(4).followers_count, 1)
+
+            c.post('/users/stop-following/2')
+            self.assertEqual(User.query.get(1).following_count, 1)
+            self.assertEqual(User.query.get(2).followers_count, 0)
+
+            resp = c.get('/users/1')
+            self.assertIn(b'<a href="/users/1/following">1</a>', resp.data)
+
+    def test_follow_updates_timeline(self):
+        """Do follows/unfollows add and drop messages from the timeline?"""
+        Timeline.rebuild(1)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/stop-following/2')
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=1).count(), 0)
+
+            c.post('/users/follow/2')
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=1).count(), 1)
+
+    def test_follow_direction(self):
+        """Do the feed, counters and fan-out agree on who follows whom?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            c.post('/users/follow/2')
+            self.assertEqual(User.query.get(4).get_following_ids([1, 2]), {2})
+            self.assertEqual(User.query.get(2).get_following_ids([4]), set())
+
+            resp = c.get('/')
+            self.assertIn(b'test message', resp.data)
+
+            User.repair_counters()
+            db.session.commit()
+            self.assertEqual(User.query.get(4).following_count, 1)
+            self.assertEqual(User.query.get(2).followers_count, 2)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.post("/messages/new", data={"text": "fanned out"})
+            self.assertEqual(
+                [m.text for m in Timeline.messages_for(4, 100)],
+                ["fanned out", "test message"])
+
+    def test_query_plans(self):
+        """Are the hot pages' queries all served by indexes?"""
+        thread_id = Thread.get_or_create_id(1, 2)
+        dm = DM(text="hi", thread_id=thread_id, author=2)
+        db.session.add(dm)
+        db.session.flush()
+        Thread.record_dm(dm)
+        User.repair_counters()
+        db.session.commit()
+
+        problems = query_plans.check(app, CURR_USER_KEY)
+        self.assertEqual(problems, [])
+
+    def test_server_timing(self):
+        """Does each request report its query count and db time?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f'/users/{self.testuser.id}/following')
+            self.assertRegex(resp.headers['Server-Timing'],
+                             r'^db;dur=[\d.]+;desc="\d+ queries", '
+                             r'app;dur=[\d.]+$')
+
+    def test_slow_request_log(self):
+        """Are requests over the query threshold logged, with their
+        queries grouped by fingerprint?"""
+        app.config['SLOW_REQUEST_QUERIES'] = 0
+        try:
+            with self.assertLogs('instrumentation', 'WARNING') as logs:
+                self.client.get(f'/users/{self.testuser.id}')
+        finally:
+            app.config['SLOW_REQUEST_QUERIES'] = 50
+
+        self.assertIn(f"slow request: GET /users/{self.testuser.id} ",
+                      logs.output[0])
+        self.assertIn("FROM messages WHERE ? = messages.user_id",
+                      logs.output[0])
+
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id IN (%(id_1)s, "
+                        "%(id_2)s) AND username = 'bob'\n  LIMIT 10"),
+            "SELECT * FROM users WHERE id IN (?, ...) AND username = ? "
+            "LIMIT ?")
+
+    def test_metrics(self):
+        """Does /metrics report request latency and user cache lookups?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get(f'/users/{self.testuser.id}')
+            resp = c.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+        self.assertRegex(text, r'warbler_request_seconds_count\{'
+                               r'method="GET",route="users_show",'
+                               r'status="200"\} [1-9]')
+        self.assertRegex(text, r'warbler_user_cache_total\{result="miss"\}'
+                               r' [1-9]')
+        self.assertIn('warbler_requests_in_progress', text)
+        self.assertIn('warbler_db_pool_checkouts_total', text)
+
     def test_show_profile(self):
         """Can show and update profile?"""
         with self.client as c:
@@ -211,6 +778,29 @@ class UserViewTestCase(TestCase):
             self.assertEqual(user.username, "testuser5")
             self.assertEqual(user.email, "test5@test.com")
 
+    def test_delete_user_with_reacted_messages(self):
+        """Does deleting a user whose messages have reactions take those
+        reactions off the reacting users' counters?"""
+        Reaction.add(4, 1, "smile")
+        Reaction.add(4, 1, "laugh")
+        db.session.add(Message(id=2, text="testuser4's", user_id=4))
+        db.session.flush()
+        Reaction.add(1, 2, "smile")
+        User.repair_counters()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            resp = c.post('/users/delete')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(User.query.get(2))
+        self.assertIsNone(Message.query.get(1))
+        self.assertEqual(User.query.get(1).reactions_count, 1)
+        self.assertEqual(User.query.get(4).reactions_count, 0)
+
     def test_delete_user(self):
         """Can delete user?"""
         with self.client as c: